@@ -1,17 +1,73 @@
+import uuid
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+
+from asgiref.sync import async_to_sync
 
+from rooms import reaper
+from rooms.cache import invalidate_room
 from rooms.models import ChatMessage, Room, RoomState, Video
+from rooms.state import state_engine
+
+PURGE_BATCH_SIZE = 5000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the Postgres planner's row estimate instead of ``COUNT(*)`` for
+    unfiltered lists of large tables, where an exact count scans every row.
+    """
+
+    threshold = 100_000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.threshold:
+                return row[0]
+        return super().count
+
+
+def search_by_id(queryset, search_term, field):
+    """Rows whose ``field`` is the UUID typed in; a text search would scan the table."""
+    if not search_term.strip():
+        return queryset, False
+    try:
+        value = uuid.UUID(search_term.strip())
+    except ValueError:
+        return queryset.none(), False
+    return queryset.filter(**{field: value}), False
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Filtered lists show "N results" without a second count of the whole table.
+    show_full_result_count = False
 
 
 class RoomStateInline(admin.StackedInline):
     model = RoomState
     can_delete = False
-    fields = ["current_time", "is_playing", "last_updated"]
+    fields = ["current_time", "is_playing", "playback_rate", "anchored_at", "last_updated"]
     readonly_fields = ["last_updated"]
 
 
 @admin.register(Room)
-class RoomAdmin(admin.ModelAdmin):
+class RoomAdmin(LargeTableAdmin):
     list_display = [
         "id",
         "host_username",
@@ -19,10 +75,15 @@ class RoomAdmin(admin.ModelAdmin):
         "host_control",
         "has_password",
         "get_state",
+        "chat_link",
     ]
     list_filter = ["host_control", "created_at"]
-    search_fields = ["id", "host_username", "video_url"]
+    list_select_related = ["state"]
+    search_fields = ["id"]
+    search_help_text = "Search by room id."
     readonly_fields = ["id", "created_at"]
+    autocomplete_fields = ["video"]
+    actions = ["purge_chat", "reset_states"]
     fieldsets = [
         (
             "Room Information",
@@ -45,6 +106,9 @@ class RoomAdmin(admin.ModelAdmin):
     ]
     inlines = [RoomStateInline]
 
+    def get_search_results(self, request, queryset, search_term):
+        return search_by_id(queryset, search_term, "pk")
+
     def has_password(self, obj):
         return bool(obj.password)
 
@@ -58,13 +122,59 @@ class RoomAdmin(admin.ModelAdmin):
 
     get_state.short_description = "Current State"
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_room(obj.pk)
+        if change and "video_url" in form.changed_data:
+            async_to_sync(state_engine.overwrite)(obj.pk, room=obj)
+
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        if formset.model is RoomState:
+            for state, _ in formset.changed_objects:
+                async_to_sync(state_engine.overwrite)(state.room_id, state=state)
+
+    def chat_link(self, obj):
+        url = reverse("admin:rooms_chatmessage_changelist")
+        return format_html('<a href="{}?room__id__exact={}">Chat</a>', url, obj.pk)
+
+    chat_link.short_description = "Chat"
+
+    @admin.action(description="Delete the chat of selected rooms")
+    def purge_chat(self, request, queryset):
+        # Batches of primary keys keep each DELETE short on rooms with huge histories.
+        deleted = 0
+        for pks in reaper.batches(ChatMessage.objects.filter(room__in=queryset), PURGE_BATCH_SIZE):
+            deleted += ChatMessage.objects.filter(pk__in=pks).delete()[0]
+        async_to_sync(reaper.forget_history)(list(queryset.values_list("pk", flat=True)))
+        self.message_user(request, f"Deleted {deleted} chat messages.")
+
+    @admin.action(description="Reset playback state of selected rooms")
+    def reset_states(self, request, queryset):
+        now = timezone.now()
+        updated = RoomState.objects.filter(room__in=queryset).update(
+            current_time=0.0, is_playing=False, playback_rate=1.0, anchored_at=now, last_updated=now
+        )
+        room_ids = list(queryset.values_list("pk", flat=True))
+        async_to_sync(state_engine.discard)(room_ids)
+        for room_id in room_ids:
+            invalidate_room(room_id)
+        self.message_user(request, f"Reset the state of {updated} rooms.")
+
 
 @admin.register(RoomState)
-class RoomStateAdmin(admin.ModelAdmin):
-    list_display = ["room", "current_time", "is_playing", "last_updated"]
+class RoomStateAdmin(LargeTableAdmin):
+    list_display = ["room_id", "current_time", "is_playing", "playback_rate", "last_updated"]
     list_filter = ["is_playing", "last_updated"]
     readonly_fields = ["last_updated"]
-    fields = ["room", "current_time", "is_playing", "last_updated"]
+    fields = ["room", "current_time", "is_playing", "playback_rate", "anchored_at", "last_updated"]
+    raw_id_fields = ["room"]
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_room(obj.room_id)
+        # Live state in Redis overrides the row until it is flushed, so update it too.
+        async_to_sync(state_engine.overwrite)(obj.room_id, state=obj)
 
 
 @admin.register(Video)
@@ -90,12 +200,20 @@ class VideoAdmin(admin.ModelAdmin):
 
 
 @admin.register(ChatMessage)
-class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ["room", "username", "content_preview", "created_at"]
-    list_filter = ["created_at", "room"]
-    search_fields = ["username", "content", "room__id"]
+class ChatMessageAdmin(LargeTableAdmin):
+    # room_id needs no join; rooms link here with ?room__id__exact=<id> instead of a
+    # sidebar filter listing every room.
+    list_display = ["room_id", "username", "content_preview", "created_at"]
+    list_filter = ["created_at"]
+    search_fields = ["room__id"]
+    search_help_text = "Search by room id."
     readonly_fields = ["id", "created_at"]
     fields = ["id", "room", "username", "content", "created_at"]
+    raw_id_fields = ["room"]
+
+    def get_search_results(self, request, queryset, search_term):
+        # An exact room id uses the (room, created_at) index.
+        return search_by_id(queryset, search_term, "room_id")
 
     def content_preview(self, obj):
         return obj.content[:50] + "..." if len(obj.content) > 50 else obj.content
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class RoomsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "rooms"
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from rooms.cache import bump_catalog_version
+        from rooms.models import Video
+
+        post_save.connect(bump_catalog_version, sender=Video)
+        post_delete.connect(bump_catalog_version, sender=Video)
@@ -0,0 +1,295 @@
+"""
+Batched chat persistence.
+
+Messages get their id and timestamp when they are received, so they can be
+broadcast straight away. The rows are buffered and written with
+``bulk_create`` once ``CHAT_FLUSH_SIZE`` messages are pending or
+``CHAT_FLUSH_INTERVAL_MS`` after the first one arrives. Batches that cannot be
+written are spilled to a Redis list and retried. At interpreter exit, anything
+still buffered, and any batch whose write the stopped event loop never saw
+finish, is written synchronously; rows already written are skipped as
+conflicts.
+
+The most recent messages of each room are also kept pre-serialized in a Redis
+list, so connecting clients get their chat history without a database query.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import redis
+
+from rooms.db import database_sync_to_async
+from rooms.models import ChatMessage, Room
+from rooms.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SPILL_KEY = "tandem:chat:spill"
+HISTORY_KEY = "tandem:room:{}:chat"
+HISTORY_READY_KEY = "tandem:room:{}:chat:ready"
+
+# On a cold cache the list still collects new messages, which may not be in
+# the database yet, for POPULATE_SCRIPT to merge.
+APPEND_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
+# Fills a cold cache from the database rows in ARGV[3:], followed by any
+# messages appended meanwhile that the rows do not include. Returns the cache.
+POPULATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('LRANGE', KEYS[1], -tonumber(ARGV[2]), -1)
+end
+local rows = {}
+local seen = {}
+for i = 3, #ARGV do
+    table.insert(rows, ARGV[i])
+    seen[cjson.decode(ARGV[i])['id']] = true
+end
+for _, row in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if not seen[cjson.decode(row)['id']] then
+        table.insert(rows, row)
+    end
+end
+redis.call('DEL', KEYS[1])
+for i = math.max(#rows - tonumber(ARGV[2]) + 1, 1), #rows do
+    redis.call('RPUSH', KEYS[1], rows[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], '1', 'EX', ARGV[1])
+return redis.call('LRANGE', KEYS[1], 0, -1)
+"""
+
+
+class ChatBackpressure(Exception):
+    pass
+
+
+def _to_row(message):
+    return json.dumps(
+        {
+            "id": str(message.id),
+            "room_id": str(message.room_id),
+            "username": message.username,
+            "content": message.content,
+            "created_at": message.created_at.isoformat(),
+        }
+    )
+
+
+def _from_row(row):
+    data = json.loads(row)
+    return ChatMessage(
+        id=uuid.UUID(data["id"]),
+        room_id=data["room_id"],
+        username=data["username"],
+        content=data["content"],
+        created_at=parse_datetime(data["created_at"]),
+    )
+
+
+def write_messages(messages):
+    """Insert ``messages``, dropping any whose room has been deleted in the meantime."""
+    try:
+        with transaction.atomic():
+            ChatMessage.objects.bulk_create(messages, ignore_conflicts=True)
+    except IntegrityError:
+        room_ids = {str(message.room_id) for message in messages}
+        live = {str(pk) for pk in Room.objects.filter(pk__in=room_ids).values_list("pk", flat=True)}
+        ChatMessage.objects.bulk_create(
+            [message for message in messages if str(message.room_id) in live],
+            ignore_conflicts=True,
+        )
+
+
+def serialize_message(message):
+    from rooms.serializers import ChatMessageSerializer
+
+    return ChatMessageSerializer(message).data
+
+
+class ChatHistoryCache:
+    """Ring buffer of the last ``CHAT_HISTORY_LIMIT`` serialized messages per room."""
+
+    @property
+    def depth(self):
+        return settings.CHAT_HISTORY_LIMIT
+
+    @property
+    def ttl(self):
+        return settings.CHAT_HISTORY_TTL
+
+    def _keys(self, room_id):
+        return HISTORY_KEY.format(room_id), HISTORY_READY_KEY.format(room_id)
+
+    async def get(self, room_id):
+        """Return the cached messages of a room, or None if the cache is cold."""
+        history_key, ready_key = self._keys(room_id)
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.exists(ready_key)
+            pipe.lrange(history_key, -self.depth, -1)
+            ready, rows = await pipe.execute()
+        if not ready:
+            return None
+        return [json.loads(row) for row in rows]
+
+    async def append(self, room_id, message):
+        """Append a serialized message; on a cold cache it is kept for ``populate`` to merge."""
+        await get_redis().eval(
+            APPEND_SCRIPT, 2, *self._keys(room_id), json.dumps(message), self.depth, self.ttl
+        )
+
+    async def populate(self, room_id, messages):
+        """Fill a cold cache from ``messages`` loaded from the database. Returns the cache."""
+        rows = [json.dumps(message) for message in messages[-self.depth :]]
+        cached = await get_redis().eval(
+            POPULATE_SCRIPT, 2, *self._keys(room_id), self.ttl, self.depth, *rows
+        )
+        return [json.loads(row) for row in cached]
+
+    async def invalidate(self, room_id):
+        await get_redis().delete(*self._keys(room_id))
+
+
+class ChatPipeline:
+    def __init__(self):
+        self._buffer = []
+        # Batches handed to the database thread, by id, until the write is seen to finish.
+        self._writing = {}
+        self._timer = None
+        self._tasks = set()
+        atexit.register(self._flush_at_exit)
+
+    @property
+    def flush_size(self):
+        return settings.CHAT_FLUSH_SIZE
+
+    @property
+    def flush_interval(self):
+        return settings.CHAT_FLUSH_INTERVAL_MS / 1000
+
+    @property
+    def max_pending(self):
+        return settings.CHAT_MAX_PENDING
+
+    @property
+    def pending(self):
+        """Messages buffered or being written."""
+        return len(self._buffer) + sum(len(batch) for batch in self._writing.values())
+
+    async def submit(self, room_id, username, content):
+        """
+        Queue a message for persistence and return the unsaved ``ChatMessage``.
+        Raises ``ChatBackpressure`` if ``CHAT_MAX_PENDING`` messages are still
+        pending after a flush, i.e. when the database is falling behind.
+        """
+        if self.pending >= self.max_pending:
+            await self.flush()
+            if self.pending >= self.max_pending:
+                raise ChatBackpressure()
+
+        message = ChatMessage(
+            id=uuid.uuid4(),
+            room_id=room_id,
+            username=username,
+            content=content,
+            created_at=timezone.now(),
+        )
+        self._buffer.append(message)
+
+        if len(self._buffer) >= self.flush_size:
+            self._spawn(self.flush())
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._spawn_flush)
+        return message
+
+    async def flush(self):
+        """Write all buffered messages. Returns the number of messages written."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return 0
+
+        batch, self._buffer = self._buffer, []
+        try:
+            await self._write(batch)
+        except Exception:
+            logger.exception("Failed to write %d chat messages, spilling to Redis", len(batch))
+            await self._spill(batch)
+            self._writing.pop(id(batch), None)
+            return 0
+
+        self._spawn(self.drain_spill())
+        return len(batch)
+
+    async def drain_spill(self, batch_size=500):
+        """Retry messages that previously failed to write."""
+        client = get_redis()
+        rows = await client.lpop(SPILL_KEY, batch_size)
+        if not rows:
+            return 0
+        messages = [_from_row(row) for row in rows]
+        try:
+            await self._write(messages)
+        except Exception:
+            logger.exception("Failed to write spilled chat messages")
+            await client.rpush(SPILL_KEY, *rows)
+            self._writing.pop(id(messages), None)
+            return 0
+        return len(messages)
+
+    async def _write(self, batch):
+        # A failed batch stays listed until it has been spilled.
+        self._writing[id(batch)] = batch
+        await database_sync_to_async(write_messages)(batch)
+        del self._writing[id(batch)]
+
+    async def _spill(self, batch):
+        try:
+            await get_redis().rpush(SPILL_KEY, *[_to_row(message) for message in batch])
+        except Exception:
+            logger.exception("Failed to spill chat messages: %s", [_to_row(m) for m in batch])
+
+    def _spawn_flush(self):
+        self._timer = None
+        self._spawn(self.flush())
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _flush_at_exit(self):
+        batch = [message for writing in self._writing.values() for message in writing]
+        batch += self._buffer
+        self._writing, self._buffer = {}, []
+        if not batch:
+            return
+        try:
+            write_messages(batch)
+        except Exception:
+            logger.exception("Failed to write %d chat messages at exit, spilling", len(batch))
+            try:
+                redis.from_url(settings.REDIS_URL).rpush(
+                    SPILL_KEY, *[_to_row(message) for message in batch]
+                )
+            except Exception:
+                logger.exception("Lost chat messages: %s", [_to_row(m) for m in batch])
+
+
+chat_history = ChatHistoryCache()
+chat_pipeline = ChatPipeline()
@@ -0,0 +1,101 @@
+"""
+Server-side playback clock.
+
+Playback is stored as an anchor (position, wall-clock time, rate) and the
+live position is extrapolated on demand. Wall-clock time is used rather than
+a monotonic clock because anchors are shared between worker processes.
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+from rooms import codec, frames, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def now():
+    return time.time()
+
+
+def extrapolate(position, is_playing, anchored_at, rate=1.0, at=None):
+    """Return the playback position at ``at`` (default: now) for an anchored clock."""
+    if not is_playing or anchored_at is None:
+        return position
+    elapsed = (now() if at is None else at) - anchored_at
+    return position + max(elapsed, 0.0) * rate
+
+
+def live_state(state):
+    """Return the client-facing view of a state engine dict, extrapolated to now."""
+    server_time = now()
+    return {
+        "current_time": extrapolate(
+            state.get("current_time", 0.0),
+            state.get("is_playing", False),
+            state.get("anchored_at"),
+            state.get("playback_rate", 1.0),
+            at=server_time,
+        ),
+        "is_playing": state.get("is_playing", False),
+        "playback_rate": state.get("playback_rate", 1.0),
+        "server_time": server_time,
+    }
+
+
+class Ticker:
+    """
+    Periodically pushes ``tick`` frames with the live position to every
+    consumer connected to this process, one state lookup per room.
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._tasks = weakref.WeakKeyDictionary()
+
+    @property
+    def interval(self):
+        return settings.PLAYBACK_TICK_INTERVAL
+
+    def register(self, room_id, consumer):
+        self._rooms.setdefault(room_id, set()).add(consumer)
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(loop)
+        if task is None or task.done():
+            self._tasks[loop] = loop.create_task(self._run())
+
+    def unregister(self, room_id, consumer):
+        consumers = self._rooms.get(room_id)
+        if consumers is None:
+            return
+        consumers.discard(consumer)
+        if not consumers:
+            del self._rooms[room_id]
+
+    async def tick(self):
+        from rooms.state import state_engine
+
+        for room_id, consumers in list(self._rooms.items()):
+            state = await state_engine.peek(room_id)
+            if not state or not state.get("is_playing"):
+                continue
+            payload = {"type": "tick", **live_state(state)}
+            frame, binary = frames.encode(payload), codec.encode(payload)
+            metrics.messages_sent.inc("tick", amount=len(consumers))
+            for consumer in list(consumers):
+                await consumer.send_encoded(frame, binary)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Playback tick failed")
+
+
+ticker = Ticker()
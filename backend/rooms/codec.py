@@ -0,0 +1,66 @@
+"""
+Binary encoding of playback frames for the ``tandem.bin.v2`` subprotocol.
+
+Clients that offer the subprotocol exchange play/pause/seek/tick frames as
+fixed-size binary messages instead of JSON text; every other frame stays JSON.
+All fields are big-endian:
+
+    play/pause/seek  type:u8 flags:u8 current_time:f64                 (10 bytes)
+      from the server, with the room event number:
+                     type:u8 flags:u8 seq:u32 current_time:f64         (14 bytes)
+    tick             type:u8 flags:u8 current_time:f64 rate:f32
+                     server_time:f64                                   (22 bytes)
+
+Bit 0 of ``flags`` is ``is_playing``. A missing ``current_time`` is sent as NaN.
+"""
+
+import math
+import struct
+
+SUBPROTOCOL = "tandem.bin.v2"
+
+PLAYBACK = struct.Struct("!BBd")
+SEQUENCED = struct.Struct("!BBId")
+TICK = struct.Struct("!BBdfd")
+
+TYPES = {"play": 1, "pause": 2, "seek": 3, "tick": 4}
+NAMES = {code: name for name, code in TYPES.items()}
+IS_PLAYING = 0x01
+
+
+def _position(value):
+    return math.nan if value is None else float(value)
+
+
+def encode(payload):
+    """Return the binary form of a frame, or None if it has no binary form."""
+    code = TYPES.get(payload.get("type"))
+    if code is None:
+        return None
+    flags = IS_PLAYING if payload.get("is_playing") else 0
+    if code == TYPES["tick"]:
+        return TICK.pack(
+            code,
+            flags,
+            _position(payload.get("current_time")),
+            payload.get("playback_rate", 1.0),
+            payload["server_time"],
+        )
+    if "seq" in payload:
+        return SEQUENCED.pack(code, flags, payload["seq"], _position(payload.get("current_time")))
+    return PLAYBACK.pack(code, flags, _position(payload.get("current_time")))
+
+
+def decode(data):
+    """Parse a client frame into the dict its JSON form would have, or None if invalid."""
+    if len(data) != PLAYBACK.size:
+        return None
+    code, flags, position = PLAYBACK.unpack(data)
+    name = NAMES.get(code)
+    if name is None or name == "tick":
+        return None
+    return {
+        "type": name,
+        "current_time": None if math.isnan(position) else position,
+        "is_playing": bool(flags & IS_PLAYING),
+    }
@@ -1,278 +1,336 @@
+import asyncio
 import json
 import logging
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-
-from rooms.models import ChatMessage, Room, RoomState
+from channels.layers import get_channel_layer
+
+from rooms import codec, frames, metrics, throttle
+from rooms.chat import ChatBackpressure, chat_history, chat_pipeline, serialize_message
+from rooms.clock import live_state, now, ticker
+from rooms.db import DatabaseBusy, database_sync_to_async
+from rooms.events import event_log
+from rooms.models import ChatMessage, Room
+from rooms.presence import presence
+from rooms.shards import room_shards
+from rooms.state import state_engine
 
 logger = logging.getLogger(__name__)
 
-room_users = {}
+PLAYBACK_EVENTS = ("play", "pause", "seek")
+# Events charged to the connection's token bucket. Playback is bounded by coalescing instead.
+THROTTLED_EVENTS = ("join", "resume", "video_change", "username_change", "chat")
+CLIENT_EVENTS = ("ping", *PLAYBACK_EVENTS, *THROTTLED_EVENTS)
+# WebSocket close code asking clients to reconnect later.
+TRY_AGAIN_LATER = 1013
+VIDEO_URL_MAX_LENGTH = Room._meta.get_field("video_url").max_length
+
+
+def parse_seq(value):
+    """A client's last seen event number, from a message or the ``resume`` query parameter."""
+    if isinstance(value, list):
+        value = value[-1]
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seq if seq >= 0 else None
+
+
+async def broadcast_expired_members(room_id, member_ids):
+    channel_layer = get_channel_layer()
+    for member_id in member_ids:
+        await event_log.publish(channel_layer, room_id, {"type": "user_left", "id": member_id})
 
 
 class RoomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
-        self.room_group_name = f"room_{self.room_id}"
+        self.room_group_name = None
         self.user_id = self.scope.get("client", ["unknown"])[0]
         self.username = None
+        self.member_id = None
+        self.attached = False
+        self.binary = codec.SUBPROTOCOL in self.scope.get("subprotocols", [])
+        self.bucket = throttle.channel_bucket()
+        self.playback = throttle.PlaybackCoalescer(self.apply_playback, self.store_playback)
+
+        resume = parse_seq(parse_qs(self.scope.get("query_string", b"").decode()).get("resume"))
+        snapshot = None
+        # Live state in Redis means the room exists, so resuming clients skip the database.
+        if resume is None or await state_engine.peek(self.room_id) is None:
+            messages = await chat_history.get(self.room_id)
+            try:
+                snapshot = await self.load_snapshot(with_messages=messages is None)
+            except (DatabaseBusy, asyncio.TimeoutError):
+                logger.warning("Rejected connection, database busy", extra={"room": self.room_id})
+                await self.close(code=TRY_AGAIN_LATER)
+                return
+            if snapshot is None:
+                logger.warning("Rejected connection to unknown room", extra={"room": self.room_id})
+                await self.close()
+                return
 
-        logger.info(f"WebSocket CONNECT: room={self.room_id}, channel={self.channel_name}")
-
-        if not await self.room_exists():
-            logger.warning(f"Room {self.room_id} does not exist")
-            await self.close()
-            return
-
+        connections = await state_engine.attach(self.room_id)
+        self.attached = True
+        metrics.connections.inc(self.room_id)
+        self.room_group_name = await room_shards.assign(
+            self.room_id, self.channel_name, connections
+        )
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
-        await self.accept()
+        await self.accept(subprotocol=codec.SUBPROTOCOL if self.binary else None)
 
-        logger.info(f"WebSocket ACCEPTED: room={self.room_id}")
-
-        current_state = await self.get_room_state()
-        room_data = await self.get_room_data()
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "room_state",
-                    "current_time": current_state["current_time"],
-                    "is_playing": current_state["is_playing"],
-                    "video_url": room_data.get("video_url", ""),
-                }
-            )
+        logger.info(
+            "WebSocket connected", extra={"room": self.room_id, "channel": self.channel_name}
         )
 
-        chat_history = await self.get_chat_history()
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "chat_history",
-                    "messages": chat_history,
-                }
-            )
+        presence.start(broadcast_expired_members)
+        ticker.register(self.room_id, self)
+
+        if resume is None or not await self.resume(resume):
+            await self.send_snapshot(snapshot)
+
+    async def send_snapshot(self, snapshot=None):
+        # Called after joining the group: the snapshot covers every event up to seq
+        # and later ones arrive live.
+        seq = await event_log.seq(self.room_id)
+        messages = await chat_history.get(self.room_id)
+        if snapshot is None or (messages is None and snapshot["messages"] is None):
+            try:
+                snapshot = await self.load_snapshot(with_messages=messages is None)
+            except (DatabaseBusy, asyncio.TimeoutError):
+                await self.close(code=TRY_AGAIN_LATER)
+                return
+            if snapshot is None:
+                await self.close()
+                return
+        if messages is None:
+            # Also picks up messages sent meanwhile that are not written to the database yet.
+            messages = await chat_history.populate(self.room_id, snapshot["messages"])
+
+        current_state = await state_engine.get(self.room_id, initial=snapshot["state"])
+        await self.send_frame(
+            {
+                "type": "snapshot",
+                "seq": seq,
+                "state": {
+                    **live_state(current_state),
+                    "video_url": current_state.get("video_url", ""),
+                },
+                "video": snapshot["video"],
+                "messages": messages,
+            }
         )
 
     async def disconnect(self, close_code):
-        if self.username and self.room_id in room_users:
-            if self.channel_name in room_users[self.room_id]:
-                del room_users[self.room_id][self.channel_name]
-                await self.broadcast_user_list()
+        if self.attached:
+            # First, so the room's series is dropped even if the rest fails.
+            metrics.connections.dec(self.room_id)
+
+        if self.member_id and await presence.leave(self.room_id, self.member_id):
+            await self.broadcast({"type": "user_left", "id": self.member_id}, exclude_self=False)
 
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.room_group_name is not None:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
-    async def receive(self, text_data):
-        logger.info(f"WebSocket RECEIVE: {text_data[:100]}")
-        data = json.loads(text_data)
+        if self.attached:
+            await self.playback.flush()
+            ticker.unregister(self.room_id, self)
+            if await state_engine.detach(self.room_id) <= 0:
+                await room_shards.reset(self.room_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            data = codec.decode(bytes_data) or {}
+        else:
+            data = json.loads(text_data)
         event_type = data.get("type")
-        logger.info(f"Event type: {event_type}, data: {data}")
+        metrics.messages_received.inc(event_type if event_type in CLIENT_EVENTS else "unknown")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received %s event",
+                event_type,
+                extra={"room": self.room_id, "channel": self.channel_name, "event": event_type},
+            )
 
-        if event_type == "join":
-            self.username = data.get("username", "Guest")
-            if self.room_id not in room_users:
-                room_users[self.room_id] = {}
-            room_users[self.room_id][self.channel_name] = self.username
-            logger.info(f"User {self.username} joined room {self.room_id}")
-            await self.broadcast_user_list()
-
-        elif event_type == "play":
-            await self.update_room_state(data.get("current_time"), True)
-            logger.info(f"Broadcasting PLAY to room {self.room_group_name}")
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "video_event",
-                    "event": "play",
-                    "current_time": data.get("current_time"),
-                    "sender_channel": self.channel_name,
-                },
+        if event_type in THROTTLED_EVENTS and not self.bucket.consume():
+            throttle.events["dropped_channel"] += 1
+            if event_type == "chat":
+                await self.send_chat_error("You are sending messages too fast")
+            return
+
+        if event_type == "ping":
+            await self.send_frame(
+                {"type": "pong", "client_time": data.get("client_time"), "server_time": now()}
             )
 
-        elif event_type == "pause":
-            await self.update_room_state(data.get("current_time"), False)
-            logger.info(f"Broadcasting PAUSE to room {self.room_group_name}")
-            await self.channel_layer.group_send(
-                self.room_group_name,
+        elif event_type == "resume":
+            seq = parse_seq(data.get("seq"))
+            if seq is None or not await self.resume(seq):
+                await self.send_snapshot()
+
+        elif event_type == "join":
+            self.username = data.get("username", "Guest")
+            if self.member_id and await presence.leave(self.room_id, self.member_id):
+                await self.broadcast({"type": "user_left", "id": self.member_id})
+            self.member_id, members = await presence.join(self.room_id, self.username)
+            logger.info("User joined", extra={"room": self.room_id, "member": self.member_id})
+            await self.send_frame({"type": "user_list", "users": members, "you": self.member_id})
+            await self.broadcast(
                 {
-                    "type": "video_event",
-                    "event": "pause",
-                    "current_time": data.get("current_time"),
-                    "sender_channel": self.channel_name,
-                },
+                    "type": "user_joined",
+                    "user": {"id": self.member_id, "username": self.username},
+                }
             )
 
-        elif event_type == "seek":
-            await self.update_room_state(data.get("current_time"), data.get("is_playing", False))
-            logger.info(f"Broadcasting SEEK to room {self.room_group_name}")
-            await self.channel_layer.group_send(
-                self.room_group_name,
+        elif event_type in PLAYBACK_EVENTS:
+            if event_type == "seek":
+                is_playing = data.get("is_playing", False)
+            else:
+                is_playing = event_type == "play"
+            await self.playback.submit(
                 {
-                    "type": "video_event",
-                    "event": "seek",
+                    "type": event_type,
                     "current_time": data.get("current_time"),
-                    "sender_channel": self.channel_name,
-                },
+                    "is_playing": is_playing,
+                }
             )
 
         elif event_type == "video_change":
             video_url = data.get("video_url", "")
-            await self.update_room_video(video_url)
-            logger.info(f"Broadcasting VIDEO_CHANGE to room {self.room_group_name}")
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "video_change_event",
-                    "video_url": video_url,
-                    "sender_channel": self.channel_name,
-                },
-            )
+            # Stored as is and written to Room.video_url on every flush until it succeeds.
+            if not isinstance(video_url, str) or len(video_url) > VIDEO_URL_MAX_LENGTH:
+                return
+            await state_engine.update(self.room_id, video_url=video_url)
+            await self.broadcast({"type": "video_changed", "video_url": video_url})
 
         elif event_type == "username_change":
             new_username = data.get("username", "Guest")
-            logger.info(f"User changing username from {self.username} to {new_username}")
             self.username = new_username
-            if self.room_id in room_users and self.channel_name in room_users[self.room_id]:
-                room_users[self.room_id][self.channel_name] = new_username
-                await self.broadcast_user_list()
+            if self.member_id and await presence.rename(
+                self.room_id, self.member_id, new_username
+            ):
+                await self.broadcast(
+                    {
+                        "type": "user_renamed",
+                        "user": {"id": self.member_id, "username": new_username},
+                    },
+                    exclude_self=False,
+                )
 
         elif event_type == "chat":
             content = data.get("content", "").strip()
             if not content or len(content) > 1000:
                 return
 
-            message_id = await self.save_chat_message(content)
-            logger.info(f"Broadcasting CHAT to room {self.room_group_name}")
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_event",
-                    "message_id": str(message_id),
-                    "username": self.username or "Guest",
-                    "content": content,
-                    "sender_channel": self.channel_name,
-                },
-            )
+            if not await throttle.allow_room(self.room_id, "chat"):
+                throttle.events["dropped_room"] += 1
+                await self.send_chat_error("Chat is busy, please try again in a moment")
+                return
 
-    async def video_event(self, event):
-        logger.info(f"video_event called: event={event['event']}, sender={event.get('sender_channel')}, self={self.channel_name}")
-        if event.get("sender_channel") != self.channel_name:
-            logger.info(f"Sending {event['event']} event to client")
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": event["event"],
-                        "current_time": event["current_time"],
-                    }
+            try:
+                message = await chat_pipeline.submit(
+                    self.room_id, self.username or "Guest", content
                 )
-            )
-        else:
-            logger.info(f"Skipping own event for channel {self.channel_name}")
-
-    @database_sync_to_async
-    def room_exists(self):
-        return Room.objects.filter(id=self.room_id).exists()
-
-    @database_sync_to_async
-    def get_room_state(self):
-        room = Room.objects.get(id=self.room_id)
-        state = room.state
-        return {
-            "current_time": float(state.current_time),
-            "is_playing": state.is_playing,
-        }
-
-    @database_sync_to_async
-    def update_room_state(self, current_time, is_playing):
-        room = Room.objects.get(id=self.room_id)
-        state = room.state
-        state.current_time = current_time
-        state.is_playing = is_playing
-        state.save()
-
-    async def broadcast_user_list(self):
-        if self.room_id in room_users:
-            users = list(room_users[self.room_id].values())
-        else:
-            users = []
+            except ChatBackpressure:
+                await self.send_chat_error("Chat is busy, please try again in a moment")
+                return
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "user_list_event",
-                "users": users,
-            }
+            payload = serialize_message(message)
+            await chat_history.append(self.room_id, payload)
+            await self.broadcast({"type": "chat_message", **payload})
+
+    async def resume(self, seq):
+        """Send the frames missed since ``seq``. Returns False if the log cannot cover them."""
+        missed = await event_log.since(self.room_id, seq)
+        if missed is None:
+            return False
+        current, missed_frames = missed
+        for frame in missed_frames:
+            await self.send(text_data=frame)
+        await self.send_frame({"type": "resumed", "seq": current, "replayed": len(missed_frames)})
+        return True
+
+    async def apply_playback(self, event):
+        """Store and broadcast a playback event. Returns False if the room is throttled."""
+        if not await throttle.allow_room(self.room_id, "playback"):
+            return False
+        await self.store_playback(event)
+        await self.broadcast({"type": event["type"], "current_time": event["current_time"]})
+        return True
+
+    async def store_playback(self, event):
+        await state_engine.update(
+            self.room_id, current_time=event["current_time"], is_playing=event["is_playing"]
         )
 
-    async def user_list_event(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_list",
-                    "users": event["users"],
-                }
+    async def send_chat_error(self, error):
+        await self.send_frame({"type": "chat_error", "error": error})
+
+    async def send_frame(self, payload):
+        metrics.messages_sent.inc(payload["type"])
+        await self.send(text_data=frames.encode(payload))
+
+    async def broadcast(self, payload, exclude_self=True):
+        """Encode ``payload`` once and fan it out to the room as a ready-made frame."""
+        with metrics.fanout_duration.time(payload["type"]):
+            await event_log.publish(
+                self.channel_layer,
+                self.room_id,
+                payload,
+                exclude=self.channel_name if exclude_self else None,
             )
-        )
 
-    async def video_change_event(self, event):
-        logger.info(f"video_change_event called: sender={event.get('sender_channel')}, self={self.channel_name}")
-        if event.get("sender_channel") != self.channel_name:
-            logger.info(f"Sending video_changed event to client")
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "video_changed",
-                        "video_url": event["video_url"],
-                    }
-                )
-            )
-        else:
-            logger.info(f"Skipping own video_change event for channel {self.channel_name}")
-
-    async def chat_event(self, event):
-        logger.info(f"chat_event called: sender={event.get('sender_channel')}, self={self.channel_name}")
-        if event.get("sender_channel") != self.channel_name:
-            logger.info(f"Sending chat message to client")
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "chat_message",
-                        "id": event["message_id"],
-                        "username": event["username"],
-                        "content": event["content"],
-                    }
-                )
-            )
+    async def room_frame(self, event):
+        metrics.messages_sent.inc(event["kind"])
+        await self.send_encoded(event["frame"], event.get("binary"))
+
+    async def send_encoded(self, frame, binary=None):
+        """Send a pre-encoded frame, in its binary form if this client negotiated one."""
+        if self.binary and binary is not None:
+            await self.send(bytes_data=binary)
         else:
-            logger.info(f"Skipping own chat message for channel {self.channel_name}")
+            await self.send(text_data=frame)
 
     @database_sync_to_async
-    def get_room_data(self):
-        room = Room.objects.get(id=self.room_id)
+    def load_snapshot(self, with_messages=True):
+        from rooms.serializers import ChatMessageSerializer, VideoSerializer
+
+        queryset = Room.objects.select_related("state", "video")
+        if with_messages:
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    "messages",
+                    queryset=ChatMessage.objects.order_by("-created_at")[
+                        : settings.CHAT_HISTORY_LIMIT
+                    ],
+                    to_attr="recent_messages",
+                )
+            )
+        try:
+            room = queryset.filter(id=self.room_id).first()
+        except ValidationError:
+            return None
+        if room is None:
+            return None
+
+        state = getattr(room, "state", None)
         return {
-            "video_url": room.video_url or "",
+            "state": {
+                "current_time": state.current_time if state else 0.0,
+                "is_playing": state.is_playing if state else False,
+                "playback_rate": state.playback_rate if state else 1.0,
+                "anchored_at": state.anchored_at.timestamp() if state else None,
+                "video_url": room.video_url or "",
+            },
+            "video": VideoSerializer(room.video).data if room.video else None,
+            "messages": (
+                ChatMessageSerializer(list(reversed(room.recent_messages)), many=True).data
+                if with_messages
+                else None
+            ),
         }
-
-    @database_sync_to_async
-    def update_room_video(self, video_url):
-        room = Room.objects.get(id=self.room_id)
-        room.video_url = video_url
-        room.save()
-
-    @database_sync_to_async
-    def save_chat_message(self, content):
-        room = Room.objects.get(id=self.room_id)
-        message = ChatMessage.objects.create(
-            room=room,
-            username=self.username or "Guest",
-            content=content,
-        )
-        return message.id
-
-    @database_sync_to_async
-    def get_chat_history(self, limit=50):
-        from rooms.serializers import ChatMessageSerializer
-
-        room = Room.objects.get(id=self.room_id)
-        messages = ChatMessage.objects.filter(room=room).order_by("-created_at")[:limit]
-        messages = list(reversed(messages))
-        return ChatMessageSerializer(messages, many=True).data
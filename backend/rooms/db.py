@@ -0,0 +1,116 @@
+"""
+Database access from async code, on a bounded pool of threads.
+
+``database_sync_to_async`` runs ORM calls on ``DB_POOL_SIZE`` dedicated
+threads. Each keeps its connection open for ``DB_POOL_CONN_MAX_AGE`` seconds,
+so the threads double as a connection pool: however many clients connect at
+once, a worker process holds at most ``DB_POOL_SIZE`` connections for realtime
+traffic. Calls beyond that wait for a free thread. Once ``DB_POOL_MAX_QUEUE``
+are waiting, new calls fail straight away with ``DatabaseBusy``, and a caller
+waiting longer than ``DB_CALL_TIMEOUT`` seconds gets ``asyncio.TimeoutError``.
+
+A call holds its thread until the query returns, even after its caller has
+given up, so it counts as in flight until then. The query itself is bounded by
+``DB_STATEMENT_TIMEOUT_MS``, which is set on the pool's connections only.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from channels.db import DatabaseSyncToAsync
+
+from rooms import metrics
+
+
+class DatabaseBusy(Exception):
+    pass
+
+
+_pool_thread = threading.local()
+
+
+def _init_thread():
+    _pool_thread.active = True
+    # Pool threads keep their connections between calls; request threads use CONN_MAX_AGE.
+    for alias in connections:
+        connection = connections[alias]
+        connection.settings_dict = {
+            **connection.settings_dict,
+            "CONN_MAX_AGE": settings.DB_POOL_CONN_MAX_AGE,
+        }
+
+
+@receiver(connection_created)
+def _set_statement_timeout(sender, connection, **kwargs):
+    if not getattr(_pool_thread, "active", False) or not settings.DB_STATEMENT_TIMEOUT_MS:
+        return
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('statement_timeout', %s, false)",
+                [str(settings.DB_STATEMENT_TIMEOUT_MS)],
+            )
+
+
+class PoolExecutor(ThreadPoolExecutor):
+    """Counts each call as in flight from submission until its thread is done with it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            metrics.db_in_flight.inc()
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+            metrics.db_in_flight.dec()
+
+
+executor = PoolExecutor(
+    max_workers=settings.DB_POOL_SIZE, thread_name_prefix="tandem-db", initializer=_init_thread
+)
+
+
+def queued():
+    """Calls waiting for a free thread."""
+    return max(executor.in_flight - settings.DB_POOL_SIZE, 0)
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    def __init__(self, func, thread_sensitive=False, executor=executor):
+        super().__init__(func, thread_sensitive=False, executor=executor)
+
+    async def __call__(self, *args, **kwargs):
+        if queued() >= settings.DB_POOL_MAX_QUEUE:
+            metrics.db_rejected.inc("busy")
+            raise DatabaseBusy(f"{executor.in_flight} database calls in flight")
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(
+                super().__call__(*args, **kwargs), settings.DB_CALL_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            metrics.db_rejected.inc("timeout")
+            raise
+        finally:
+            metrics.db_duration.observe(time.perf_counter() - start)
+
+
+# Drop-in replacement, used as a decorator or a wrapper like the original.
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
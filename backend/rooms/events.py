@@ -0,0 +1,100 @@
+"""
+Sequenced log of room broadcasts.
+
+Every broadcast to a room is numbered from a per-room counter and appended to
+a Redis stream capped at about ``EVENT_LOG_LENGTH`` entries, with the number
+stamped into the frame as ``seq``. A reconnecting client sends the last
+``seq`` it saw and gets only the frames it missed, or a full snapshot when the
+log no longer reaches back that far. Frames can arrive both from the log and
+live around a resume, so clients drop any ``seq`` they have already seen.
+Numbers are assigned before the broadcast, so concurrent publishers can deliver
+them out of order; clients fill gaps with a resume rather than dropping late
+frames. The counter expires with the log, after which numbering restarts and
+older resume points get a snapshot.
+
+Playback ticks are not logged; each one supersedes the last.
+"""
+
+from django.conf import settings
+
+from rooms import frames
+from rooms.redis_client import get_redis
+from rooms.shards import room_shards
+
+LOG_KEY = "tandem:room:{}:events"
+SEQ_KEY = "tandem:room:{}:seq"
+
+# Numbers the frame, stamps the number into its JSON and appends it under the
+# stream id "<seq>-0". Returns {seq, stamped frame}.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+local frame = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'f', frame)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {seq, frame}
+"""
+
+# Returns {current seq, frames after ARGV[1]...}, or false if some have been trimmed.
+SINCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+local after = tonumber(ARGV[1])
+if after > current then
+    return false
+end
+local result = {current}
+if after == current then
+    return result
+end
+local first = redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', 1)
+if #first == 0 or tonumber(string.match(first[1][1], '^%d+')) > after + 1 then
+    return false
+end
+for _, entry in ipairs(redis.call('XRANGE', KEYS[1], (after + 1) .. '-0', '+')) do
+    table.insert(result, entry[2][2])
+end
+return result
+"""
+
+
+class RoomEventLog:
+    @property
+    def length(self):
+        return settings.EVENT_LOG_LENGTH
+
+    @property
+    def ttl(self):
+        return settings.EVENT_LOG_TTL
+
+    def _keys(self, room_id):
+        return LOG_KEY.format(room_id), SEQ_KEY.format(room_id)
+
+    async def append(self, room_id, payload):
+        """Log ``payload`` and return ``(seq, encoded frame carrying the seq)``."""
+        seq, frame = await get_redis().eval(
+            APPEND_SCRIPT, 2, *self._keys(room_id), frames.encode(payload), self.length, self.ttl
+        )
+        return int(seq), frame
+
+    async def publish(self, channel_layer, room_id, payload, exclude=None):
+        """Log ``payload`` and broadcast it to the room."""
+        seq, frame = await self.append(room_id, payload)
+        # The binary form is built from the payload, so it needs the seq as well.
+        message = frames.room_message({**payload, "seq": seq}, frame=frame)
+        await room_shards.group_send(channel_layer, room_id, message, exclude=exclude)
+
+    async def seq(self, room_id):
+        return int(await get_redis().get(SEQ_KEY.format(room_id)) or 0)
+
+    async def since(self, room_id, seq):
+        """
+        Return ``(current seq, frames after seq)``, or None if the log cannot fill
+        the gap and the client needs a snapshot.
+        """
+        result = await get_redis().eval(SINCE_SCRIPT, 2, *self._keys(room_id), seq)
+        if not result:
+            return None
+        return int(result[0]), result[1:]
+
+
+event_log = RoomEventLog()
@@ -0,0 +1,42 @@
+"""
+Encoding of client-facing WebSocket frames.
+
+Broadcast frames are encoded once by the sender and carried as ready-made
+text in the group message, along with the binary form for clients of the
+binary subprotocol, so recipients only forward them. orjson is used when it
+is installed.
+"""
+
+import json
+
+from rooms import codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode(payload):
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload).decode()
+        except TypeError:
+            pass
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def room_message(payload, frame=None):
+    """
+    Build the channel-layer message that delivers ``payload`` to every member of a
+    room, as ``frame`` if it has already been encoded.
+    """
+    message = {
+        "type": "room_frame",
+        "kind": payload["type"],
+        "frame": encode(payload) if frame is None else frame,
+    }
+    binary = codec.encode(payload)
+    if binary is not None:
+        message["binary"] = binary
+    return message
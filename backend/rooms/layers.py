@@ -0,0 +1,237 @@
+"""
+Channel layers with sender exclusion.
+
+``group_send(group, message, exclude=channel_name)`` skips the given channel
+when fanning out, so the client that originated a room event does not get its
+own event delivered back through the layer only to drop it. A room of N
+members costs N-1 deliveries.
+
+``HybridRoomChannelLayer`` delivers to group members in the same process
+straight from memory and publishes each group message to Redis once, for the
+other processes with members in the group. Redis pub/sub is fire-and-forget:
+a process that is disconnected from Redis misses what is published meanwhile.
+"""
+
+import asyncio
+import logging
+import uuid
+import weakref
+
+import msgpack
+import redis.asyncio as aioredis
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from rooms import metrics
+
+logger = logging.getLogger(__name__)
+
+EXCLUDE_KEY = "__exclude_channel__"
+
+
+class RoomChannelLayer(RedisChannelLayer):
+    async def send(self, channel, message):
+        with metrics.layer_send_duration.time("send"):
+            await super().send(channel, message)
+
+    async def group_send(self, group, message, exclude=None):
+        if exclude is not None:
+            message = {**message, EXCLUDE_KEY: exclude}
+        with metrics.layer_send_duration.time("group_send"):
+            await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Called by group_send with the group's members; the excluded channel
+        # is dropped here so no message is queued for it at all.
+        exclude = message.get(EXCLUDE_KEY)
+        if exclude is not None:
+            message = {key: value for key, value in message.items() if key != EXCLUDE_KEY}
+            channel_names = [name for name in channel_names if name != exclude]
+        return super()._map_channel_keys_to_connection(channel_names, message)
+
+
+class InMemoryRoomChannelLayer(InMemoryChannelLayer):
+    async def group_send(self, group, message, exclude=None):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._clean_expired()
+        for channel in self.groups.get(group, set()):
+            if channel == exclude:
+                continue
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
+
+
+class HybridRoomChannelLayer(BaseChannelLayer):
+    """
+    Each event loop is a node with its own channels, named
+    ``<prefix>specific.<node>!<id>``. Nodes subscribe to a pub/sub channel of their
+    own, for direct sends, and to one per group they have members in. Only the
+    first of ``hosts`` is used.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, hosts=None, prefix="asgi", expiry=60, capacity=100, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.host = (hosts or ["redis://localhost:6379"])[0]
+        self.prefix = prefix
+        self._nodes = weakref.WeakKeyDictionary()
+
+    def connect(self):
+        """A Redis client for a new node."""
+        return aioredis.Redis.from_url(self.host)
+
+    def _node(self):
+        loop = asyncio.get_running_loop()
+        node = self._nodes.get(loop)
+        if node is None:
+            node = self._nodes[loop] = _Node(self)
+        return node
+
+    async def new_channel(self, prefix="specific."):
+        return await self._node().new_channel()
+
+    async def send(self, channel, message):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        with metrics.layer_send_duration.time("send"):
+            await self._node().send(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        return await self._node().receive(channel)
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        await self._node().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        await self._node().group_discard(group, channel)
+
+    async def group_send(self, group, message, exclude=None):
+        assert self.valid_group_name(group), "Group name not valid"
+        with metrics.layer_send_duration.time("group_send"):
+            await self._node().group_send(group, message, exclude)
+
+    async def flush(self):
+        node = self._nodes.pop(asyncio.get_running_loop(), None)
+        if node is not None:
+            await node.close()
+
+
+class _Node:
+    def __init__(self, layer):
+        self.layer = layer
+        self.id = uuid.uuid4().hex
+        self.channel_prefix = f"{layer.prefix}specific.{self.id}!"
+        self.channels = {}
+        self.groups = {}
+        self.redis = layer.connect()
+        self.pubsub = self.redis.pubsub()
+        self._reader = None
+
+    def _topic(self, kind, name):
+        return f"{self.layer.prefix}:{kind}:{name}"
+
+    async def _start(self):
+        if self._reader is None:
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+            await self.pubsub.subscribe(self._topic("node", self.id))
+
+    async def new_channel(self):
+        await self._start()
+        channel = f"{self.channel_prefix}{uuid.uuid4().hex}"
+        self.channels[channel] = asyncio.Queue(maxsize=self.layer.capacity)
+        return channel
+
+    async def send(self, channel, message):
+        if channel.startswith(self.channel_prefix):
+            self._deliver(channel, message, raise_full=True)
+            return
+        node = channel[len(self.layer.prefix) :].removeprefix("specific.").split("!")[0]
+        payload = msgpack.packb({"c": channel, "m": message})
+        await self.redis.publish(self._topic("node", node), payload)
+
+    async def receive(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.layer.capacity)
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer is gone; forget its channel and groups.
+            self.channels.pop(channel, None)
+            for group in [group for group, members in self.groups.items() if channel in members]:
+                await self.group_discard(group, channel)
+            raise
+
+    async def group_add(self, group, channel):
+        members = self.groups.setdefault(group, set())
+        if not members:
+            await self._start()
+            await self.pubsub.subscribe(self._topic("group", group))
+        members.add(channel)
+
+    async def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            await self.pubsub.unsubscribe(self._topic("group", group))
+
+    async def group_send(self, group, message, exclude=None):
+        self._deliver_group(group, message, exclude)
+        payload = msgpack.packb({"n": self.id, "g": group, "x": exclude, "m": message})
+        await self.redis.publish(self._topic("group", group), payload)
+
+    def _deliver(self, channel, message, raise_full=False):
+        queue = self.channels.get(channel)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if raise_full:
+                raise ChannelFull(channel)
+
+    def _deliver_group(self, group, message, exclude=None):
+        for channel in self.groups.get(group, ()):
+            if channel != exclude:
+                self._deliver(channel, message)
+
+    async def _read(self):
+        while True:
+            try:
+                if not self.pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                received = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+            except RedisConnectionError:
+                logger.warning("Channel layer lost its Redis subscription, reconnecting")
+                await asyncio.sleep(1)
+                continue
+            if received is None:
+                continue
+            try:
+                payload = msgpack.unpackb(received["data"])
+                if "c" in payload:
+                    self._deliver(payload["c"], payload["m"])
+                elif payload["n"] != self.id:
+                    self._deliver_group(payload["g"], payload["m"], payload["x"])
+            except Exception:
+                logger.exception("Dropped an undeliverable channel layer message")
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.pubsub.aclose()
+        await self.redis.aclose()
@@ -0,0 +1,74 @@
+"""
+Logging helpers for the realtime hot paths.
+
+``JsonFormatter`` renders one JSON object per record, including any
+``extra`` fields such as ``room`` and ``event``. ``RoomRateFilter`` samples
+records that carry a ``room`` so a busy room cannot flood the log; the number
+of records dropped since the last one that got through is attached to it as
+``suppressed``.
+"""
+
+import json
+import logging
+import time
+
+# Attributes every LogRecord has; anything else was passed through ``extra``.
+RESERVED_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RESERVED_ATTRS and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RoomRateFilter(logging.Filter):
+    """
+    Token bucket per (room, message template): lets ``rate`` records per second
+    through with bursts of up to ``burst``. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate=5, burst=20, name=""):
+        super().__init__(name)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._buckets = {}
+
+    def filter(self, record):
+        room = getattr(record, "room", None)
+        if room is None or record.levelno >= logging.WARNING:
+            return True
+
+        key = (room, record.msg)
+        now = time.monotonic()
+        tokens, updated, suppressed = self._buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, suppressed + 1)
+            return False
+
+        if suppressed:
+            record.suppressed = suppressed
+        self._buckets[key] = (tokens - 1, now, 0)
+        if len(self._buckets) > 10000:
+            self._prune(now)
+        return True
+
+    def _prune(self, now):
+        # Buckets that have refilled completely carry no state worth keeping.
+        idle = self.burst / self.rate if self.rate else 0
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if now - bucket[1] < idle or bucket[2]
+        }
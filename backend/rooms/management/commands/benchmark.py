@@ -0,0 +1,216 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from rooms import codec, frames
+from rooms.cache import ainvalidate_room
+from rooms.chat import ChatPipeline
+from rooms.db import database_sync_to_async
+from rooms.models import ChatMessage, Room, RoomState
+from rooms.state import state_engine
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks of the realtime hot paths against the configured database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=["chat", "broadcast", "codec", "layer", "rooms"])
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument(
+            "--members",
+            type=int,
+            nargs="+",
+            default=[10, 100, 500, 1000],
+            help="Room sizes for the broadcast and layer scenarios",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=50,
+            help="Rooms loaded and updated at once in the rooms scenario",
+        )
+
+    def handle(self, *args, **options):
+        getattr(self, f"bench_{options['scenario']}")(options)
+
+    def report(self, label, count, elapsed, unit="messages"):
+        rate = count / elapsed if elapsed else float("inf")
+        self.stdout.write(f"{label:<28} {count:>8} {unit} in {elapsed:8.3f}s  {rate:12.1f}/s")
+
+    def bench_chat(self, options):
+        count = options["messages"]
+        room = Room.objects.create(host_username="benchmark")
+        RoomState.objects.create(room=room)
+        try:
+            elapsed = async_to_sync(self._chat_per_message)(room.pk, count)
+            self.report("per-message create", count, elapsed)
+            elapsed = async_to_sync(self._chat_pipeline)(room.pk, count)
+            self.report("batched pipeline", count, elapsed)
+        finally:
+            room.delete()
+
+    async def _chat_per_message(self, room_id, count):
+        @database_sync_to_async
+        def save(content):
+            room = Room.objects.get(id=room_id)
+            ChatMessage.objects.create(room=room, username="bench", content=content)
+
+        start = time.perf_counter()
+        for i in range(count):
+            await save(f"message {i}")
+        return time.perf_counter() - start
+
+    async def _chat_pipeline(self, room_id, count):
+        pipeline = ChatPipeline()
+        start = time.perf_counter()
+        for i in range(count):
+            await pipeline.submit(room_id, "bench", f"message {i}")
+        await pipeline.flush()
+        return time.perf_counter() - start
+
+    def bench_broadcast(self, options):
+        count = options["messages"]
+        payload = {
+            "type": "chat_message",
+            "id": "6f1c1a52-2a51-4d0e-9a57-0f0d7f2b6c11",
+            "username": "bench",
+            "content": "x" * 120,
+            "created_at": "2024-01-01T00:00:00.000000Z",
+        }
+        for members in options["members"]:
+            start = time.process_time()
+            for _ in range(count):
+                for _ in range(members):
+                    json.dumps(payload)
+            self.report(f"per-recipient dumps x{members}", count, time.process_time() - start)
+
+            start = time.process_time()
+            for _ in range(count):
+                frame = frames.encode(payload)
+                for _ in range(members):
+                    frame.encode()
+            self.report(f"encode once x{members}", count, time.process_time() - start)
+
+    def bench_codec(self, options):
+        count = options["messages"]
+        payloads = [
+            {"type": "seek", "current_time": 1234.567, "is_playing": True},
+            {
+                "type": "tick",
+                "current_time": 1234.567,
+                "is_playing": True,
+                "playback_rate": 1.0,
+                "server_time": 1700000000.123,
+            },
+        ]
+        for payload in payloads:
+            text = frames.encode(payload)
+            binary = codec.encode(payload)
+            self.stdout.write(
+                f"{payload['type']}: {len(text)} bytes as JSON, {len(binary)} as binary"
+            )
+
+            start = time.process_time()
+            for _ in range(count):
+                json.loads(frames.encode(payload))
+            self.report(f"json {payload['type']}", count, time.process_time() - start, "frames")
+
+            start = time.process_time()
+            if payload["type"] == "tick":
+                for _ in range(count):
+                    codec.TICK.unpack(codec.encode(payload))
+            else:
+                for _ in range(count):
+                    codec.decode(codec.encode(payload))
+            self.report(f"binary {payload['type']}", count, time.process_time() - start, "frames")
+
+    def bench_layer(self, options):
+        count = options["messages"]
+        for members in options["members"]:
+            elapsed = async_to_sync(self._layer_fanout)(count, members)
+            self.report(f"group_send to {members} members", count, elapsed)
+
+    async def _layer_fanout(self, count, members):
+        """Time group sends to consumers in this process until every member has received them."""
+        channel_layer = get_channel_layer()
+        group = "benchmark"
+        channels = [await channel_layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await channel_layer.group_add(group, channel)
+        message = {"type": "room_frame", "kind": "chat_message", "frame": "x" * 200}
+        try:
+            start = time.perf_counter()
+            for _ in range(count):
+                await channel_layer.group_send(group, message)
+                for channel in channels:
+                    await channel_layer.receive(channel)
+            return time.perf_counter() - start
+        finally:
+            for channel in channels:
+                await channel_layer.group_discard(group, channel)
+
+    def bench_rooms(self, options):
+        """Concurrent snapshot loads and state writes, as on connects and flushes."""
+        count = options["messages"]
+        rooms = [
+            Room.objects.create(host_username="benchmark") for _ in range(options["concurrency"])
+        ]
+        RoomState.objects.bulk_create([RoomState(room=room) for room in rooms])
+        room_ids = [room.pk for room in rooms]
+        try:
+            for label, operation in (
+                ("snapshot, async ORM", self._snapshot_async),
+                ("snapshot, DB thread pool", self._snapshot_pool),
+                ("state get-then-save", self._state_save),
+                ("state single UPDATE", self._state_update),
+                ("state cache invalidation", self._state_invalidate),
+            ):
+                elapsed = async_to_sync(self._concurrently)(operation, room_ids, count)
+                self.report(label, count, elapsed, "operations")
+        finally:
+            Room.objects.filter(pk__in=room_ids).delete()
+
+    async def _concurrently(self, operation, room_ids, count):
+        start = time.perf_counter()
+        for offset in range(0, count, len(room_ids)):
+            batch = room_ids[: count - offset]
+            await asyncio.gather(*(operation(room_id, offset) for room_id in batch))
+        return time.perf_counter() - start
+
+    def _snapshot_queryset(self, room_id):
+        recent = Prefetch(
+            "messages", queryset=ChatMessage.objects.order_by("-created_at")[:50], to_attr="recent"
+        )
+        return (
+            Room.objects.select_related("state", "video")
+            .prefetch_related(recent)
+            .filter(id=room_id)
+        )
+
+    async def _snapshot_async(self, room_id, i):
+        # Django's async API runs every query on one shared thread.
+        return await self._snapshot_queryset(room_id).afirst()
+
+    @database_sync_to_async
+    def _snapshot_pool(self, room_id, i):
+        return self._snapshot_queryset(room_id).first()
+
+    @database_sync_to_async
+    def _state_save(self, room_id, i):
+        state = RoomState.objects.get(room_id=room_id)
+        state.current_time = float(i)
+        state.is_playing = True
+        state.save()
+
+    async def _state_update(self, room_id, i):
+        # Only the row writes, like _state_save; a flush also invalidates the cache.
+        await state_engine._update_rows(room_id, {"current_time": float(i), "is_playing": True})
+
+    async def _state_invalidate(self, room_id, i):
+        await ainvalidate_room(room_id)
@@ -0,0 +1,80 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rooms import reaper
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive idle rooms and old chat to gzipped JSONL files and delete them in batches. "
+        "Meant to be run periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--idle-days",
+            type=float,
+            default=settings.ROOM_IDLE_DAYS,
+            help="Reap rooms with no state change, chat or connections for this many days",
+        )
+        parser.add_argument(
+            "--chat-days",
+            type=float,
+            default=settings.CHAT_RETENTION_DAYS,
+            help="Also reap chat older than this many days from live rooms (0 keeps it)",
+        )
+        parser.add_argument("--archive-dir", default=settings.ROOM_ARCHIVE_DIR)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Count what would be reaped without changes"
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        dry_run = options["dry_run"]
+        batch_size = options["batch_size"]
+        verb = "Would reap" if dry_run else "Reaped"
+
+        archive = None if dry_run else reaper.Archive(options["archive_dir"], "rooms")
+        start = time.perf_counter()
+        rooms = messages = 0
+        try:
+            cutoff = reaper.days_ago(options["idle_days"])
+            for batch_rooms, batch_messages in reaper.reap_rooms(cutoff, batch_size, archive):
+                rooms += batch_rooms
+                messages += batch_messages
+                self.progress(rooms, messages, start)
+        finally:
+            if archive is not None:
+                archive.close()
+        self.report(f"{verb} {rooms} idle rooms with {messages} messages", rooms, start, archive)
+
+        if not options["chat_days"]:
+            return
+        archive = None if dry_run else reaper.Archive(options["archive_dir"], "chat")
+        start = time.perf_counter()
+        messages = 0
+        try:
+            cutoff = reaper.days_ago(options["chat_days"])
+            for batch_messages in reaper.reap_messages(cutoff, batch_size, archive):
+                messages += batch_messages
+                self.progress(0, messages, start)
+        finally:
+            if archive is not None:
+                archive.close()
+        self.report(f"{verb} {messages} old chat messages", messages, start, archive)
+
+    def progress(self, rooms, messages, start):
+        if self.verbosity >= 2:
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"  {rooms} rooms, {messages} messages after {elapsed:.1f}s")
+
+    def report(self, summary, count, start, archive):
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed else float("inf")
+        line = f"{summary} in {elapsed:.1f}s ({rate:.1f}/s)"
+        if archive is not None and archive.records:
+            line += f", archived to {archive.path} ({archive.size} bytes)"
+        self.stdout.write(self.style.SUCCESS(line))
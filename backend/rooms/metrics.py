@@ -0,0 +1,256 @@
+"""
+Process-local metrics for the realtime layer, in the Prometheus text format.
+
+Metrics are only collected when ``METRICS_ENABLED`` is set; otherwise every
+metric is a shared no-op object and instrumentation costs a method call.
+Each worker process exposes its own values on ``/metrics``, so scrape every
+worker (or sum them in Prometheus). Labels include room ids, which are enough
+to join a room, so scrapes must send ``Authorization: Bearer <METRICS_TOKEN>``.
+
+Metrics are updated from the event loop and the database pool threads while
+``/metrics`` renders them on a request thread, so each metric guards its values
+with a lock and is rendered from a copy.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """A metric; ``collect`` may return a ``{labels: value}`` dict read at scrape time."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def snapshot(self):
+        """A copy of ``{labels: value}`` that is safe to iterate."""
+        if self.collect is not None:
+            values = dict(self.collect())
+            with self._lock:
+                self._values = values
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for labels, value in self.snapshot().items():
+            yield self.name, labels, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, labels, extra)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._store(labels, value)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._store(labels, self._values.get(labels, 0) + amount)
+
+    def dec(self, *labels, amount=1):
+        with self._lock:
+            self._store(labels, self._values.get(labels, 0) - amount)
+
+    def _store(self, labels, value):
+        if value or not labels:
+            self._values[labels] = value
+        else:
+            # Drop labelled series that reach zero, e.g. rooms everyone has left.
+            self._values.pop(labels, None)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                labels: (list(counts), count, total)
+                for labels, (counts, count, total) in self._values.items()
+            }
+
+    def samples(self):
+        for labels, (counts, count, total) in self.snapshot().items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", labels, (("le", bound),), bucket_count
+            yield f"{self.name}_bucket", labels, (("le", "+Inf"),), count
+            yield f"{self.name}_count", labels, (), count
+            yield f"{self.name}_sum", labels, (), total
+
+
+class NullMetric:
+    def inc(self, *labels, amount=1):
+        pass
+
+    def dec(self, *labels, amount=1):
+        pass
+
+    def set(self, value, *labels):
+        pass
+
+    def observe(self, value, *labels):
+        pass
+
+    @contextmanager
+    def time(self, *labels):
+        yield
+
+
+NULL = NullMetric()
+
+
+def _create(cls, *args, **kwargs):
+    return cls(*args, **kwargs) if settings.METRICS_ENABLED else NULL
+
+
+def _throttle_events():
+    from rooms.throttle import events
+
+    # Copied in one step; the event loop keeps counting meanwhile.
+    return {(action,): count for action, count in list(events.items())}
+
+
+def _db_queued():
+    from rooms.db import queued
+
+    return {(): queued()}
+
+
+def _chat_pending():
+    from rooms.chat import chat_pipeline
+
+    return {(): chat_pipeline.pending}
+
+
+connections = _create(
+    Gauge, "tandem_ws_connections", "Open WebSocket connections per room", ["room"]
+)
+messages_received = _create(
+    Counter, "tandem_ws_messages_received_total", "Client messages received by type", ["type"]
+)
+messages_sent = _create(
+    Counter, "tandem_ws_messages_sent_total", "Frames sent to clients by type", ["type"]
+)
+fanout_duration = _create(
+    Histogram,
+    "tandem_fanout_duration_seconds",
+    "Time to hand a room broadcast to the channel layer",
+    ["type"],
+)
+layer_send_duration = _create(
+    Histogram, "tandem_channel_layer_send_seconds", "Channel layer send latency", ["operation"]
+)
+db_in_flight = _create(
+    Gauge, "tandem_db_calls_in_flight", "Database calls from async code queued or running"
+)
+db_queued = _create(
+    Gauge,
+    "tandem_db_calls_queued",
+    "Database calls from async code waiting for a pool thread",
+    collect=_db_queued,
+)
+db_duration = _create(
+    Histogram,
+    "tandem_db_call_duration_seconds",
+    "Database call duration from async code, including time spent queued",
+)
+db_rejected = _create(
+    Counter,
+    "tandem_db_calls_rejected_total",
+    "Database calls from async code refused with a full queue or timed out",
+    ["reason"],
+)
+throttled_events = _create(
+    Counter,
+    "tandem_throttled_events_total",
+    "Client events dropped, merged, deferred or stored without a broadcast by rate limiting",
+    ["action"],
+    collect=_throttle_events,
+)
+chat_pending = _create(
+    Gauge,
+    "tandem_chat_pending_messages",
+    "Chat messages waiting to be written",
+    collect=_chat_pending,
+)
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+    authorization = request.headers.get("Authorization", "")
+    if not settings.METRICS_TOKEN or not constant_time_compare(
+        authorization, f"Bearer {settings.METRICS_TOKEN}"
+    ):
+        return HttpResponse(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.14 on 2026-10-17 20:42
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rooms", "0005_add_chat_message"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="roomstate",
+            name="anchored_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now,
+                help_text="Wall-clock time at which current_time was recorded",
+            ),
+        ),
+        migrations.AddField(
+            model_name="roomstate",
+            name="playback_rate",
+            field=models.FloatField(default=1.0),
+        ),
+    ]
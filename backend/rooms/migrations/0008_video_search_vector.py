@@ -0,0 +1,66 @@
+# Generated by Django 5.0.14 on 2026-10-17 21:15
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# The 'simple' configuration does no stemming or stop words, which suits a
+# catalog with titles in several languages. rooms.search uses the same one.
+FORWARDS_SQL = [
+    """
+    CREATE FUNCTION rooms_video_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER rooms_video_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON rooms_video
+    FOR EACH ROW EXECUTE FUNCTION rooms_video_search_vector_update()
+    """,
+    "UPDATE rooms_video SET title = title",
+    "CREATE INDEX rooms_video_search_vector_gin ON rooms_video USING gin (search_vector)",
+    "CREATE INDEX rooms_video_title_trgm ON rooms_video USING gin (title gin_trgm_ops)",
+]
+
+BACKWARDS_SQL = [
+    "DROP INDEX IF EXISTS rooms_video_title_trgm",
+    "DROP INDEX IF EXISTS rooms_video_search_vector_gin",
+    "DROP TRIGGER IF EXISTS rooms_video_search_vector_trigger ON rooms_video",
+    "DROP FUNCTION IF EXISTS rooms_video_search_vector_update()",
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rooms", "0007_chatmessage_created_at_default"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name="video",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False,
+                help_text="Weighted title/description tsvector, maintained by a database trigger",
+                null=True,
+            ),
+        ),
+        migrations.RunPython(run_on_postgres(FORWARDS_SQL), run_on_postgres(BACKWARDS_SQL)),
+    ]
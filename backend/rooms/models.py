@@ -1,6 +1,10 @@
 import uuid
 
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.utils import timezone
+
+from rooms.clock import extrapolate
 
 
 class Video(models.Model):
@@ -24,6 +28,11 @@ class Video(models.Model):
     thumbnail = models.URLField(max_length=500, blank=True, null=True)
     duration = models.IntegerField(blank=True, null=True, help_text="Duration in seconds")
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        help_text="Weighted title/description tsvector, maintained by a database trigger",
+    )
 
     def __str__(self):
         return self.title
@@ -56,10 +65,24 @@ class RoomState(models.Model):
     room = models.OneToOneField(Room, on_delete=models.CASCADE, related_name="state")
     current_time = models.FloatField(default=0.0)
     is_playing = models.BooleanField(default=False)
+    playback_rate = models.FloatField(default=1.0)
+    anchored_at = models.DateTimeField(
+        default=timezone.now, help_text="Wall-clock time at which current_time was recorded"
+    )
     last_updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return f"State for Room {self.room.id}"
+        return f"State for Room {self.room_id}"
+
+    def position(self, at=None):
+        """Playback position extrapolated from the anchor to ``at`` (epoch seconds)."""
+        return extrapolate(
+            self.current_time,
+            self.is_playing,
+            self.anchored_at.timestamp() if self.anchored_at else None,
+            self.playback_rate,
+            at=at,
+        )
 
     class Meta:
         verbose_name = "Room State"
@@ -71,10 +94,10 @@ class ChatMessage(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="messages")
     username = models.CharField(max_length=100)
     content = models.TextField(max_length=1000)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
-        return f"{self.username} in Room {self.room.id}: {self.content[:50]}"
+        return f"{self.username} in Room {self.room_id}: {self.content[:50]}"
 
     class Meta:
         ordering = ["created_at"]
@@ -0,0 +1,237 @@
+import base64
+import datetime
+import json
+import uuid
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """Keeps the microseconds that DjangoJSONEncoder drops from datetimes and times."""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def get_limit(request, default, maximum):
+    try:
+        limit = int(request.query_params.get("limit", default))
+    except ValueError:
+        return default
+    return max(1, min(limit, maximum))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over ``(created_at, id)``.
+
+    Without a cursor the newest page is returned. ``?before=<cursor>`` walks
+    back in time and ``?after=<cursor>`` forward; each page is in chronological
+    order and carries the cursors of its oldest and newest items.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        before = self.decode_cursor(request.query_params.get("before"))
+        after = self.decode_cursor(request.query_params.get("after"))
+
+        if after is not None:
+            created_at, pk = after
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+            ).order_by("created_at", "id")
+            items = list(queryset[: self.limit + 1])
+            self.has_newer = len(items) > self.limit
+            self.has_older = True
+            self.page = items[: self.limit]
+        else:
+            if before is not None:
+                created_at, pk = before
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                )
+            items = list(queryset.order_by("-created_at", "-id")[: self.limit + 1])
+            self.has_older = len(items) > self.limit
+            self.has_newer = before is not None
+            self.page = list(reversed(items[: self.limit]))
+        return self.page
+
+    def get_paginated_response(self, data):
+        first = self.page[0] if self.page else None
+        last = self.page[-1] if self.page else None
+        return Response(
+            {
+                "before": self.encode_cursor(first) if first and self.has_older else None,
+                "after": self.encode_cursor(last) if last else None,
+                "has_newer": self.has_newer,
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "before": {"type": "string", "nullable": True},
+                "after": {"type": "string", "nullable": True},
+                "has_newer": {"type": "boolean"},
+                "results": schema,
+            },
+        }
+
+    def get_limit(self, request):
+        return get_limit(request, self.page_size, self.max_page_size)
+
+    def encode_cursor(self, item):
+        raw = f"{item.created_at.isoformat()}|{item.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            created_at = parse_datetime(created_at)
+            pk = uuid.UUID(pk)
+        except (ValueError, TypeError, UnicodeDecodeError):
+            raise ParseError(self.invalid_cursor_message)
+        if created_at is None:
+            raise ParseError(self.invalid_cursor_message)
+        return created_at, pk
+
+
+class OrderingCursorPagination(BasePagination):
+    """
+    Forward-only keyset pagination that keeps the ordering chosen by the filter
+    backends (``?ordering=``, search relevance) or the view's default.
+
+    Pages are keyed on every ordering term plus ``id``, so each page is a range
+    scan from the previous one however deep the client goes. Nulls sort last
+    in both directions, which keeps nullable fields paging the same way on
+    every database. ``?cursor=`` comes from the previous page's ``next`` link
+    and is only valid for the ordering it was issued with.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = get_limit(request, self.page_size, self.max_page_size)
+        self.ordering = self.get_ordering(queryset, view)
+        self.model = queryset.model
+        values = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+
+        queryset = queryset.order_by(
+            *(
+                F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_last=True)
+                for name, descending in self.terms
+            )
+        )
+        if values is not None:
+            queryset = queryset.filter(self.after(values))
+        items = list(queryset[: self.limit + 1])
+        self.has_next = len(items) > self.limit
+        self.page = items[: self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "format": "uri", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_ordering(self, queryset, view):
+        ordering = (
+            queryset.query.order_by
+            or getattr(view, "ordering", None)
+            or queryset.model._meta.ordering
+        )
+        if isinstance(ordering, str):
+            ordering = [ordering]
+        # Only plain local fields and annotations can be read back off an item.
+        ordering = [
+            term
+            for term in ordering
+            if isinstance(term, str)
+            and term.lstrip("-") not in ("id", "pk", "?")
+            and "__" not in term
+        ]
+        return ordering + ["id"]
+
+    @property
+    def terms(self):
+        return [(term.lstrip("-"), term.startswith("-")) for term in self.ordering]
+
+    def after(self, values):
+        """Items past ``values`` in ``self.ordering``, with nulls after everything else."""
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, descending), value in zip(self.terms, values):
+            if value is not None:
+                beyond = Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+                condition |= equal & (beyond | Q(**{f"{name}__isnull": True}))
+                equal &= Q(**{name: value})
+            else:
+                equal &= Q(**{f"{name}__isnull": True})
+        return condition
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        item = self.page[-1]
+        values = [getattr(item, self.attname(name)) for name, _ in self.terms]
+        raw = json.dumps({"o": self.ordering, "v": values}, cls=CursorEncoder)
+        cursor = base64.urlsafe_b64encode(raw.encode()).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, cursor
+        )
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if data["o"] != self.ordering or len(data["v"]) != len(self.ordering):
+                raise ValueError
+            return [self.to_python(name, value) for (name, _), value in zip(self.terms, data["v"])]
+        except (ValueError, TypeError, KeyError, UnicodeDecodeError, ValidationError):
+            raise ParseError(self.invalid_cursor_message)
+
+    def attname(self, name):
+        try:
+            return self.model._meta.get_field(name).attname
+        except FieldDoesNotExist:
+            return name
+
+    def to_python(self, name, value):
+        if value is None:
+            return None
+        try:
+            field = self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # Annotations such as search rank are plain numbers.
+            return float(value)
+        return field.to_python(value)
@@ -0,0 +1,163 @@
+"""
+Cluster-wide presence for rooms.
+
+Each room keeps a Redis hash of member id -> username and a sorted set of
+member id -> heartbeat expiry. Every worker heartbeats the members connected
+to it and periodically sweeps expired members, so users held by a crashed
+worker disappear after ``PRESENCE_TTL`` seconds.
+"""
+
+import asyncio
+import logging
+import math
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+
+from rooms.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+MEMBERS_KEY = "tandem:room:{}:presence"
+HEARTBEATS_KEY = "tandem:room:{}:heartbeats"
+ROOMS_KEY = "tandem:presence:rooms"
+
+LEAVE_SCRIPT = """
+local removed = redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+return removed
+"""
+
+RENAME_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+EXPIRE_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, member in ipairs(stale) do
+    redis.call('HDEL', KEYS[1], member)
+    redis.call('ZREM', KEYS[2], member)
+end
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+return stale
+"""
+
+
+class PresenceRegistry:
+    def __init__(self, sweep_batch=100):
+        self.sweep_batch = sweep_batch
+        self._local = {}
+        self._tasks = weakref.WeakKeyDictionary()
+        self._on_expire = None
+
+    @property
+    def ttl(self):
+        return settings.PRESENCE_TTL
+
+    @property
+    def key_ttl(self):
+        return math.ceil(self.ttl * 2)
+
+    def _keys(self, room_id):
+        return MEMBERS_KEY.format(room_id), HEARTBEATS_KEY.format(room_id), ROOMS_KEY
+
+    async def join(self, room_id, username):
+        """Register a new member and return ``(member_id, members)``."""
+        member_id = uuid.uuid4().hex
+        members_key, heartbeats_key, rooms_key = self._keys(room_id)
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(members_key, member_id, username)
+            pipe.zadd(heartbeats_key, {member_id: time.time() + self.ttl})
+            pipe.sadd(rooms_key, str(room_id))
+            pipe.expire(members_key, self.key_ttl)
+            pipe.expire(heartbeats_key, self.key_ttl)
+            pipe.hgetall(members_key)
+            results = await pipe.execute()
+        self._local[member_id] = room_id
+        return member_id, self._as_list(results[-1])
+
+    async def leave(self, room_id, member_id):
+        self._local.pop(member_id, None)
+        removed = await get_redis().eval(
+            LEAVE_SCRIPT, 3, *self._keys(room_id), member_id, str(room_id)
+        )
+        return bool(removed)
+
+    async def rename(self, room_id, member_id, username):
+        renamed = await get_redis().eval(
+            RENAME_SCRIPT, 2, *self._keys(room_id)[:2], member_id, username
+        )
+        return bool(renamed)
+
+    async def members(self, room_id):
+        return self._as_list(await get_redis().hgetall(MEMBERS_KEY.format(room_id)))
+
+    async def count(self, room_id):
+        return await get_redis().hlen(MEMBERS_KEY.format(room_id))
+
+    def start(self, on_expire):
+        """
+        Start heartbeating local members on the running event loop.
+        ``on_expire(room_id, member_ids)`` is awaited for members swept as stale.
+        """
+        self._on_expire = on_expire
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(loop)
+        if task is None or task.done():
+            self._tasks[loop] = loop.create_task(self._run())
+
+    async def heartbeat(self):
+        if not self._local:
+            return
+        expiry = time.time() + self.ttl
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for member_id, room_id in list(self._local.items()):
+                members_key, heartbeats_key, _ = self._keys(room_id)
+                pipe.zadd(heartbeats_key, {member_id: expiry}, xx=True)
+                pipe.expire(members_key, self.key_ttl)
+                pipe.expire(heartbeats_key, self.key_ttl)
+            await pipe.execute()
+
+    async def sweep(self):
+        redis = get_redis()
+        room_ids = await redis.srandmember(ROOMS_KEY, self.sweep_batch)
+        now = time.time()
+        expired = {}
+        for room_id in room_ids:
+            stale = await redis.eval(EXPIRE_SCRIPT, 3, *self._keys(room_id), now, room_id)
+            if stale:
+                expired[room_id] = stale
+        return expired
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.heartbeat()
+                expired = await self.sweep()
+                for room_id, member_ids in expired.items():
+                    logger.info(
+                        "Expired %d stale members", len(member_ids), extra={"room": room_id}
+                    )
+                    if self._on_expire is not None:
+                        await self._on_expire(room_id, member_ids)
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+
+    @staticmethod
+    def _as_list(members):
+        return [{"id": member_id, "username": username} for member_id, username in members.items()]
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,221 @@
+"""
+Archival and deletion of idle rooms and old chat.
+
+A room is idle once neither its playback state nor its chat has changed for
+``ROOM_IDLE_DAYS`` and nobody is connected to it. Idle rooms are written to a
+gzipped JSONL archive together with their state and chat, then deleted with
+everything they own. Independently, chat older than ``CHAT_RETENTION_DAYS`` is
+archived and deleted from rooms that are still in use.
+
+Everything is done in batches of primary keys, each archived and flushed to
+disk before it is deleted in its own short transaction, so no statement locks
+more than one batch of rows. The chat of idle rooms is deleted in batches
+before the rooms themselves, which then only cascade to their state rows.
+
+A room that gets used again while its batch is being reaped is kept, with a
+``kept`` record following its archived rows. Its chat from before the cutoff
+may already be deleted (and is in the archive); a later run archives the room
+again.
+"""
+
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from asgiref.sync import async_to_sync
+
+from rooms.cache import invalidate_room
+from rooms.chat import HISTORY_KEY, HISTORY_READY_KEY, chat_history
+from rooms.events import LOG_KEY, SEQ_KEY
+from rooms.models import ChatMessage, Room
+from rooms.presence import HEARTBEATS_KEY, MEMBERS_KEY, ROOMS_KEY
+from rooms.redis_client import get_redis
+from rooms.shards import SHARDS_KEY
+from rooms.state import CONNECTIONS_KEY, DIRTY_KEY, STATE_KEY, WORKERS_KEY
+
+ROOM_FIELDS = ("id", "created_at", "video_id", "video_url", "host_control", "host_username")
+STATE_FIELDS = ("current_time", "is_playing", "playback_rate", "anchored_at", "last_updated")
+MESSAGE_FIELDS = ("id", "room_id", "username", "content", "created_at")
+
+
+def idle_rooms(cutoff):
+    """Rooms whose state and chat have not changed since ``cutoff``."""
+    return (
+        Room.objects.filter(created_at__lt=cutoff)
+        .filter(Q(state__last_updated__lt=cutoff) | Q(state__isnull=True))
+        .exclude(messages__created_at__gte=cutoff)
+    )
+
+
+def old_messages(cutoff):
+    return ChatMessage.objects.filter(created_at__lt=cutoff)
+
+
+def batches(queryset, size):
+    """Yield lists of primary keys, keyset-paginated so each query is a range scan."""
+    queryset = queryset.order_by("pk").values_list("pk", flat=True)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        pks = list(page[:size])
+        if not pks:
+            return
+        yield pks
+        last = pks[-1]
+
+
+async def _live(room_ids):
+    """The subset of ``room_ids`` with connections, members or unflushed state in Redis."""
+    now = time.time()
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            # Workers with a live heartbeat, so connections of crashed workers do not count.
+            pipe.zcount(WORKERS_KEY.format(room_id), now, "+inf")
+            pipe.hlen(MEMBERS_KEY.format(room_id))
+            pipe.sismember(DIRTY_KEY, str(room_id))
+        results = await pipe.execute()
+    live = set()
+    for i, room_id in enumerate(room_ids):
+        workers, members, dirty = results[i * 3 : i * 3 + 3]
+        if workers or members or dirty:
+            live.add(room_id)
+    return live
+
+
+async def _forget(room_ids):
+    """Drop the Redis state of deleted rooms."""
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.delete(
+                STATE_KEY.format(room_id),
+                CONNECTIONS_KEY.format(room_id),
+                WORKERS_KEY.format(room_id),
+                SHARDS_KEY.format(room_id),
+                MEMBERS_KEY.format(room_id),
+                HEARTBEATS_KEY.format(room_id),
+                HISTORY_KEY.format(room_id),
+                HISTORY_READY_KEY.format(room_id),
+                LOG_KEY.format(room_id),
+                SEQ_KEY.format(room_id),
+            )
+        if room_ids:
+            pipe.srem(DIRTY_KEY, *map(str, room_ids))
+            pipe.srem(ROOMS_KEY, *map(str, room_ids))
+        await pipe.execute()
+
+
+async def forget_history(room_ids):
+    for room_id in room_ids:
+        await chat_history.invalidate(room_id)
+
+
+class Archive:
+    """Append-only gzipped JSONL file, synced to disk by ``flush``. Removed if left empty."""
+
+    def __init__(self, directory, label):
+        os.makedirs(directory, exist_ok=True)
+        stamp = timezone.now().strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(directory, f"{label}-{stamp}.jsonl.gz")
+        self._raw = open(self.path, "ab")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        self.records = 0
+
+    def write(self, kind, row):
+        record = {"kind": kind, **row}
+        self._file.write((json.dumps(record, cls=DjangoJSONEncoder) + "\n").encode())
+        self.records += 1
+
+    def flush(self):
+        self._file.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        self._file.close()
+        self._raw.close()
+        if not self.records:
+            os.remove(self.path)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+
+def archive_messages(archive, queryset):
+    count = 0
+    rows = queryset.order_by("room_id", "created_at", "id").values(*MESSAGE_FIELDS)
+    for row in rows.iterator(chunk_size=2000):
+        archive.write("message", row)
+        count += 1
+    return count
+
+
+def reap_rooms(cutoff, batch_size, archive=None):
+    """
+    Archive and delete idle rooms. Yields ``(rooms, messages)`` per batch; with no
+    ``archive`` nothing is written or deleted and the counts are what would be.
+    """
+    for pks in batches(idle_rooms(cutoff), batch_size):
+        live = async_to_sync(_live)(pks)
+        pks = [pk for pk in pks if pk not in live]
+        if not pks:
+            continue
+        messages = ChatMessage.objects.filter(room_id__in=pks, created_at__lt=cutoff)
+        if archive is None:
+            yield len(pks), messages.count()
+            continue
+
+        state_fields = [f"state__{name}" for name in STATE_FIELDS]
+        for row in Room.objects.filter(pk__in=pks).values(*ROOM_FIELDS, *state_fields):
+            state = {name: row.pop(f"state__{name}") for name in STATE_FIELDS}
+            archive.write("room", {**row, "state": state if state["anchored_at"] else None})
+        archive_messages(archive, messages)
+        archive.flush()
+
+        idle = pks
+        deleted_messages = 0
+        for message_pks in batches(messages, batch_size):
+            # Re-check idleness so the chat of rooms that woke up is left alone.
+            idle = list(idle_rooms(cutoff).filter(pk__in=idle).values_list("pk", flat=True))
+            deleted_messages += ChatMessage.objects.filter(
+                pk__in=message_pks, room_id__in=idle
+            ).delete()[0]
+
+        with transaction.atomic():
+            still_idle = idle_rooms(cutoff).filter(pk__in=idle).select_for_update(of=("self",))
+            deleted = list(still_idle.values_list("pk", flat=True))
+            Room.objects.filter(pk__in=deleted).delete()
+        for pk in set(pks) - set(deleted):
+            archive.write("kept", {"id": pk})
+        archive.flush()
+        async_to_sync(_forget)(deleted)
+        for pk in deleted:
+            invalidate_room(pk)
+        yield len(deleted), deleted_messages
+
+
+def reap_messages(cutoff, batch_size, archive=None):
+    """Archive and delete chat older than ``cutoff``. Yields the messages per batch."""
+    for pks in batches(old_messages(cutoff), batch_size):
+        if archive is None:
+            yield len(pks)
+            continue
+        messages = ChatMessage.objects.filter(pk__in=pks)
+        room_ids = list(messages.values_list("room_id", flat=True).distinct())
+        archive_messages(archive, messages)
+        archive.flush()
+        with transaction.atomic():
+            deleted, _ = messages.delete()
+        async_to_sync(forget_history)(room_ids)
+        yield deleted
+
+
+def days_ago(days):
+    return timezone.now() - timedelta(days=days)
@@ -0,0 +1,18 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+
+import redis.asyncio as redis
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """Return the Redis client bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+        _clients[loop] = client
+    return client
@@ -0,0 +1,40 @@
+"""
+Catalog search.
+
+On Postgres ``?search=`` runs a full-text query against the trigger-maintained
+``Video.search_vector`` (title weighted above description), falls back to
+trigram similarity on the title to tolerate typos, and orders results by
+relevance unless an explicit ``?ordering=`` is given. Other databases use
+DRF's ``icontains`` search.
+"""
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast
+
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+SEARCH_CONFIG = "simple"
+
+
+class VideoSearchFilter(filters.SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        if connection.vendor != "postgresql":
+            return super().filter_queryset(request, queryset, view)
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        text = " ".join(terms)
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        # Both functions return real; as double precision the values survive a round
+        # trip through a pagination cursor exactly.
+        queryset = queryset.annotate(
+            rank=Cast(SearchRank(F("search_vector"), query), FloatField()),
+            similarity=Cast(TrigramSimilarity("title", text), FloatField()),
+        ).filter(Q(search_vector=query) | Q(title__trigram_similar=text))
+        if api_settings.ORDERING_PARAM in request.query_params:
+            return queryset
+        return queryset.order_by("-rank", "-similarity", "-created_at")
@@ -1,9 +1,32 @@
+import math
+
+from django.utils import timezone
+
 from rest_framework import serializers
 
 from rooms.models import ChatMessage, Room, RoomState, Video
 
+# Browsers refuse playback rates above 16x.
+MAX_PLAYBACK_RATE = 16.0
+
+
+class SparseFieldsMixin:
+    """Limits GET responses to the fields named in ``?fields=a,b``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return
+        requested = request.query_params.get("fields")
+        if not requested:
+            return
+        keep = {name.strip() for name in requested.split(",")}
+        for name in set(self.fields) - keep:
+            self.fields.pop(name)
 
-class VideoSerializer(serializers.ModelSerializer):
+
+class VideoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Video
         fields = [
@@ -24,11 +47,35 @@ class VideoSerializer(serializers.ModelSerializer):
 class RoomStateSerializer(serializers.ModelSerializer):
     class Meta:
         model = RoomState
-        fields = ["current_time", "is_playing", "last_updated"]
-        read_only_fields = ["last_updated"]
+        fields = ["current_time", "is_playing", "playback_rate", "anchored_at", "last_updated"]
+        read_only_fields = ["anchored_at", "last_updated"]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data["current_time"] = instance.position()
+        return data
+
+    def validate_current_time(self, value):
+        if not math.isfinite(value) or value < 0:
+            raise serializers.ValidationError("Must be a non-negative number of seconds.")
+        return value
+
+    def validate_playback_rate(self, value):
+        if not math.isfinite(value) or not 0 < value <= MAX_PLAYBACK_RATE:
+            raise serializers.ValidationError(
+                f"Must be greater than 0 and at most {MAX_PLAYBACK_RATE:g}."
+            )
+        return value
+
+    def update(self, instance, validated_data):
+        if "current_time" in validated_data or "is_playing" in validated_data:
+            if "current_time" not in validated_data:
+                validated_data["current_time"] = instance.position()
+            validated_data["anchored_at"] = timezone.now()
+        return super().update(instance, validated_data)
 
 
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     state = RoomStateSerializer(read_only=True)
     video = VideoSerializer(read_only=True)
 
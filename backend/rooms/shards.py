@@ -0,0 +1,99 @@
+"""
+Sharded channel groups for large rooms.
+
+A room starts with the single group ``room_<id>``. Once it has more than
+``ROOM_SHARD_SIZE`` connections, more groups (``room_<id>.1``, ``room_<id>.2``,
+...) are added and new connections are spread over them by channel name, so
+no single group key holds every member. Broadcasts go to all shards of the
+room concurrently.
+
+Broadcasters cache the shard count for ``ROOM_SHARD_SETTLE / 2`` seconds. A
+new shard only starts taking members ``ROOM_SHARD_SETTLE`` seconds after it
+is announced, by which time every process sends to it. Shards are dropped
+when the room empties.
+"""
+
+import asyncio
+import math
+import time
+import zlib
+
+from django.conf import settings
+
+from rooms.redis_client import get_redis
+
+SHARDS_KEY = "tandem:room:{}:shards"
+
+# Returns the number of shards new members may be assigned to.
+JOIN_SCRIPT = """
+local count = tonumber(redis.call('HGET', KEYS[1], 'count') or '1')
+local usable = tonumber(redis.call('HGET', KEYS[1], 'usable') or '1')
+local announced_at = tonumber(redis.call('HGET', KEYS[1], 'announced_at') or '0')
+local needed = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local settle = tonumber(ARGV[3])
+if now - announced_at >= settle then
+    usable = count
+end
+if needed > count then
+    count = needed
+    announced_at = now
+end
+redis.call('HSET', KEYS[1], 'count', count, 'usable', usable,
+    'announced_at', tostring(announced_at))
+return usable
+"""
+
+
+def group_name(room_id, shard=0):
+    return f"room_{room_id}" if shard == 0 else f"room_{room_id}.{shard}"
+
+
+class RoomShards:
+    def __init__(self):
+        self._counts = {}
+
+    @property
+    def size(self):
+        return settings.ROOM_SHARD_SIZE
+
+    @property
+    def settle(self):
+        return settings.ROOM_SHARD_SETTLE
+
+    async def assign(self, room_id, channel_name, connections):
+        """Return the group a channel joins, given the room's connection count including it."""
+        needed = math.ceil(connections / self.size)
+        if needed <= 1:
+            # Shard 0 always receives broadcasts, so small rooms need no lookup.
+            return group_name(room_id)
+        usable = await get_redis().eval(
+            JOIN_SCRIPT, 1, SHARDS_KEY.format(room_id), needed, time.time(), self.settle
+        )
+        return group_name(room_id, zlib.crc32(channel_name.encode()) % int(usable))
+
+    async def groups(self, room_id):
+        """Return every group that may hold members of the room."""
+        count, expires = self._counts.get(room_id, (1, 0))
+        now = time.monotonic()
+        if now >= expires:
+            stored = await get_redis().hget(SHARDS_KEY.format(room_id), "count")
+            count = int(stored or 1)
+            self._counts[room_id] = (count, now + self.settle / 2)
+        return [group_name(room_id, shard) for shard in range(count)]
+
+    async def group_send(self, channel_layer, room_id, message, exclude=None):
+        groups = await self.groups(room_id)
+        if len(groups) == 1:
+            await channel_layer.group_send(groups[0], message, exclude=exclude)
+            return
+        await asyncio.gather(
+            *(channel_layer.group_send(group, message, exclude=exclude) for group in groups)
+        )
+
+    async def reset(self, room_id):
+        self._counts.pop(room_id, None)
+        await get_redis().delete(SHARDS_KEY.format(room_id))
+
+
+room_shards = RoomShards()
@@ -0,0 +1,322 @@
+"""
+Authoritative playback state for live rooms.
+
+Play/pause/seek/video changes are written to a Redis hash per room and
+flushed to ``RoomState``/``Room`` in the background, so database writes scale
+with the number of active rooms instead of the number of client events.
+Rooms with unflushed changes are tracked in a Redis set, which lets any worker
+pick up the flush if the one that received the events dies.
+
+Each worker records its own connection count per room and heartbeats it like
+presence does, so connections held by a crashed worker stop counting after
+``PRESENCE_TTL`` seconds. The state hash expires ``ROOM_STATE_TTL`` seconds
+after the last update or heartbeat, once the room is flushed and empty.
+"""
+
+import asyncio
+import logging
+import math
+import time
+import uuid
+import weakref
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from rooms import clock
+from rooms.cache import ainvalidate_room
+from rooms.db import database_sync_to_async
+from rooms.models import Room, RoomState
+from rooms.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = "tandem:room:{}:state"
+CONNECTIONS_KEY = "tandem:room:{}:connections"
+WORKERS_KEY = "tandem:room:{}:workers"
+DIRTY_KEY = "tandem:rooms:dirty"
+
+FIELDS = ("current_time", "is_playing", "playback_rate", "anchored_at", "video_url")
+FLOAT_FIELDS = ("current_time", "playback_rate", "anchored_at")
+
+# Records this worker's connection count for the room (ARGV[1], ARGV[2]) with a
+# heartbeat expiry, drops workers whose heartbeat has lapsed and returns the
+# room's total. KEYS are the count hash, the expiry sorted set and the state hash.
+CONNECTIONS_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[4])
+for _, worker in ipairs(stale) do
+    redis.call('HDEL', KEYS[1], worker)
+    redis.call('ZREM', KEYS[2], worker)
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    redis.call('EXPIRE', KEYS[3], ARGV[6])
+else
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+local total = 0
+for _, count in ipairs(redis.call('HVALS', KEYS[1])) do
+    total = total + tonumber(count)
+end
+return total
+"""
+
+
+def _encode(fields):
+    encoded = {}
+    for name, value in fields.items():
+        if name not in FIELDS or value is None:
+            continue
+        if name == "is_playing":
+            encoded[name] = "1" if value else "0"
+        elif name in FLOAT_FIELDS:
+            encoded[name] = repr(float(value))
+        else:
+            encoded[name] = value
+    return encoded
+
+
+def _decode(raw):
+    state = {}
+    for name in FLOAT_FIELDS:
+        if name in raw:
+            state[name] = float(raw[name])
+    if "is_playing" in raw:
+        state["is_playing"] = raw["is_playing"] == "1"
+    if "video_url" in raw:
+        state["video_url"] = raw["video_url"]
+    return state
+
+
+class RoomStateEngine:
+    def __init__(self, flush_batch=100):
+        self.flush_batch = flush_batch
+        self.worker_id = uuid.uuid4().hex
+        self._local = {}
+        self._flushers = weakref.WeakKeyDictionary()
+        self._heartbeats = weakref.WeakKeyDictionary()
+
+    @property
+    def flush_interval(self):
+        return settings.ROOM_STATE_FLUSH_INTERVAL
+
+    @property
+    def ttl(self):
+        return settings.ROOM_STATE_TTL
+
+    @property
+    def heartbeat_ttl(self):
+        return settings.PRESENCE_TTL
+
+    async def get(self, room_id, initial=None):
+        """
+        Return the live state of a room, seeding Redis from ``initial`` or the
+        database on a miss. Returns None if the room has no state at all.
+        """
+        redis = get_redis()
+        key = STATE_KEY.format(room_id)
+        raw = await redis.hgetall(key)
+        if "loaded" in raw:
+            return _decode(raw)
+
+        if initial is None:
+            initial = await self._load(room_id)
+            if initial is None:
+                return None
+
+        # HSETNX keeps any newer values written while we were loading.
+        async with redis.pipeline(transaction=True) as pipe:
+            for name, value in _encode(initial).items():
+                pipe.hsetnx(key, name, value)
+            pipe.hset(key, "loaded", "1")
+            pipe.expire(key, self.ttl)
+            pipe.hgetall(key)
+            results = await pipe.execute()
+        return _decode(results[-1])
+
+    async def peek(self, room_id):
+        """Return the live state if it is held in Redis, without touching the database."""
+        raw = await get_redis().hgetall(STATE_KEY.format(room_id))
+        if "loaded" not in raw:
+            return None
+        return _decode(raw)
+
+    async def update(self, room_id, dirty=True, **fields):
+        """
+        Store new state fields. Setting ``current_time`` re-anchors the playback
+        clock at the current wall-clock time unless ``anchored_at`` is given.
+        """
+        if fields.get("current_time") is not None:
+            fields.setdefault("anchored_at", clock.now())
+        encoded = _encode(fields)
+        if not encoded:
+            return
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(STATE_KEY.format(room_id), mapping=encoded)
+            pipe.expire(STATE_KEY.format(room_id), self.ttl)
+            if dirty:
+                pipe.sadd(DIRTY_KEY, str(room_id))
+            await pipe.execute()
+        if "video_url" in encoded:
+            await ainvalidate_room(room_id)
+
+    async def overwrite(self, room_id, state=None, room=None):
+        """Replace the live state with ``RoomState``/``Room`` rows just saved outside a consumer."""
+        fields = {}
+        if state is not None:
+            fields.update(
+                current_time=state.current_time,
+                is_playing=state.is_playing,
+                playback_rate=state.playback_rate,
+                anchored_at=state.anchored_at.timestamp(),
+            )
+        if room is not None:
+            fields["video_url"] = room.video_url or ""
+        await self.update(room_id, dirty=False, **fields)
+
+    async def discard(self, room_ids):
+        """Drop the live state of rooms, e.g. after resetting their rows, so it is reloaded."""
+        if not room_ids:
+            return
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(*(STATE_KEY.format(room_id) for room_id in room_ids))
+            pipe.srem(DIRTY_KEY, *map(str, room_ids))
+            await pipe.execute()
+
+    async def attach(self, room_id):
+        """Count a new connection to the room on this worker. Returns the room's total."""
+        self.start()
+        self._local[room_id] = self._local.get(room_id, 0) + 1
+        return await get_redis().eval(CONNECTIONS_SCRIPT, 3, *self._connections_args(room_id))
+
+    async def detach(self, room_id):
+        """Forget a connection, flushing the state once the room is empty. Returns the total."""
+        count = self._local.pop(room_id, 0) - 1
+        if count > 0:
+            self._local[room_id] = count
+        remaining = await get_redis().eval(CONNECTIONS_SCRIPT, 3, *self._connections_args(room_id))
+        if remaining <= 0:
+            await self.flush(room_id)
+        return remaining
+
+    async def heartbeat(self):
+        if not self._local:
+            return
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for room_id in list(self._local):
+                pipe.eval(CONNECTIONS_SCRIPT, 3, *self._connections_args(room_id))
+            await pipe.execute()
+
+    def _connections_args(self, room_id):
+        now = time.time()
+        return (
+            CONNECTIONS_KEY.format(room_id),
+            WORKERS_KEY.format(room_id),
+            STATE_KEY.format(room_id),
+            self.worker_id,
+            self._local.get(room_id, 0),
+            now + self.heartbeat_ttl,
+            now,
+            math.ceil(self.heartbeat_ttl * 2),
+            self.ttl,
+        )
+
+    async def flush(self, room_id):
+        """Write a room's pending state to the database. Returns True if anything was written."""
+        redis = get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.srem(DIRTY_KEY, str(room_id))
+            pipe.hgetall(STATE_KEY.format(room_id))
+            removed, raw = await pipe.execute()
+        if not removed:
+            return False
+
+        try:
+            await self._write(room_id, _decode(raw))
+        except Exception:
+            logger.exception("Failed to flush state for room %s", room_id)
+            await redis.sadd(DIRTY_KEY, str(room_id))
+            return False
+        return True
+
+    async def flush_dirty(self):
+        room_ids = await get_redis().srandmember(DIRTY_KEY, self.flush_batch)
+        flushed = 0
+        for room_id in room_ids:
+            if await self.flush(room_id):
+                flushed += 1
+        return flushed
+
+    def start(self):
+        """Start the periodic flusher and heartbeat on the running event loop if not running."""
+        loop = asyncio.get_running_loop()
+        for tasks, run in (
+            (self._flushers, self._run_flusher),
+            (self._heartbeats, self._run_heartbeat),
+        ):
+            task = tasks.get(loop)
+            if task is None or task.done():
+                tasks[loop] = loop.create_task(run())
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_dirty()
+            except Exception:
+                logger.exception("Room state flush failed")
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception("Room connection heartbeat failed")
+
+    @database_sync_to_async
+    def _load(self, room_id):
+        state = RoomState.objects.select_related("room").filter(room_id=room_id).first()
+        if state is None:
+            return None
+        return {
+            "current_time": state.current_time,
+            "is_playing": state.is_playing,
+            "playback_rate": state.playback_rate,
+            "anchored_at": state.anchored_at.timestamp(),
+            "video_url": state.room.video_url or "",
+        }
+
+    async def _write(self, room_id, state):
+        await self._update_rows(room_id, state)
+        await ainvalidate_room(room_id)
+
+    @database_sync_to_async
+    def _update_rows(self, room_id, state):
+        """Single UPDATE statements, without reading the rows first."""
+        updates = {
+            name: state[name]
+            for name in ("current_time", "is_playing", "playback_rate")
+            if name in state
+        }
+        if "anchored_at" in state:
+            updates["anchored_at"] = datetime.fromtimestamp(
+                state["anchored_at"], tz=dt_timezone.utc
+            )
+        with transaction.atomic():
+            if updates:
+                RoomState.objects.filter(room_id=room_id).update(
+                    last_updated=timezone.now(), **updates
+                )
+            if "video_url" in state:
+                Room.objects.filter(pk=room_id).update(video_url=state["video_url"])
+
+
+state_engine = RoomStateEngine()
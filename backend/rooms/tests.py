@@ -1,3 +1,935 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import gzip
+import json
+import tempfile
+import threading
+import time
+import weakref
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+import fakeredis
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from rooms import chat, clock, codec, db, metrics, reaper, redis_client, throttle
+from rooms.admin import RoomStateAdmin
+from rooms.chat import ChatBackpressure, ChatHistoryCache, ChatPipeline
+from rooms.consumers import RoomConsumer
+from rooms.events import LOG_KEY, SEQ_KEY, event_log
+from rooms.layers import HybridRoomChannelLayer, InMemoryRoomChannelLayer
+from rooms.models import ChatMessage, Room, RoomState, Video
+from rooms.pagination import KeysetPagination
+from rooms.presence import HEARTBEATS_KEY, ROOMS_KEY, PresenceRegistry
+from rooms.redis_client import get_redis
+from rooms.shards import SHARDS_KEY, RoomShards, room_shards
+from rooms.state import DIRTY_KEY, RoomStateEngine, state_engine
+from tandem.routing import websocket_urlpatterns
+
+TEST_SETTINGS = {
+    "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "rooms.layers.InMemoryRoomChannelLayer"}},
+}
+
+
+class FakeRedisClients(weakref.WeakKeyDictionary):
+    """Stands in for the per-loop clients of ``get_redis``, all on one in-memory server."""
+
+    def __init__(self):
+        super().__init__()
+        self.server = fakeredis.FakeServer()
+
+    def get(self, loop, default=None):
+        client = super().get(loop)
+        if client is None:
+            client = self[loop] = fakeredis.FakeAsyncRedis(
+                server=self.server, decode_responses=True
+            )
+        return client
+
+
+class FakeRedisMixin:
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(redis_client, "_clients", FakeRedisClients())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class PresenceTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.presence = PresenceRegistry()
+
+    async def test_join_lists_every_member(self):
+        redis = get_redis()
+        first, _ = await self.presence.join("room", "Ann")
+        second, members = await self.presence.join("room", "Bob")
+        self.assertCountEqual(
+            members, [{"id": first, "username": "Ann"}, {"id": second, "username": "Bob"}]
+        )
+        self.assertTrue(await redis.sismember(ROOMS_KEY, "room"))
+
+    async def test_leave(self):
+        redis = get_redis()
+        member_id, _ = await self.presence.join("room", "Ann")
+        self.assertTrue(await self.presence.leave("room", member_id))
+        self.assertFalse(await self.presence.leave("room", member_id))
+        self.assertEqual(await self.presence.members("room"), [])
+        self.assertFalse(await redis.sismember(ROOMS_KEY, "room"))
+
+    async def test_rename(self):
+        member_id, _ = await self.presence.join("room", "Ann")
+        self.assertTrue(await self.presence.rename("room", member_id, "Anna"))
+        self.assertFalse(await self.presence.rename("room", "gone", "Nobody"))
+        self.assertEqual(
+            await self.presence.members("room"), [{"id": member_id, "username": "Anna"}]
+        )
+
+    async def test_sweep_expires_members_without_heartbeat(self):
+        redis = get_redis()
+        live, _ = await self.presence.join("room", "Ann")
+        stale, _ = await self.presence.join("room", "Bob")
+        # Bob's worker died: its heartbeat lapsed and nobody refreshes it.
+        self.presence._local.pop(stale)
+        await redis.zadd(HEARTBEATS_KEY.format("room"), {stale: 0})
+        await self.presence.heartbeat()
+
+        self.assertEqual(await self.presence.sweep(), {"room": [stale]})
+        self.assertEqual(await self.presence.members("room"), [{"id": live, "username": "Ann"}])
+        self.assertEqual(await self.presence.sweep(), {})
+
+
+class ChatHistoryTests(FakeRedisMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.history = ChatHistoryCache()
+        self.messages = [{"id": str(i), "username": "Ann", "content": str(i)} for i in range(3)]
+
+    async def test_populate_keeps_messages_sent_while_cold(self):
+        # Message 2 was broadcast but is still buffered, so the database only has 0 and 1.
+        await self.history.append("room", self.messages[2])
+        self.assertIsNone(await self.history.get("room"))
+
+        self.assertEqual(await self.history.populate("room", self.messages[:2]), self.messages)
+        self.assertEqual(await self.history.get("room"), self.messages)
+
+    async def test_populate_skips_messages_already_written(self):
+        await self.history.append("room", self.messages[2])
+        self.assertEqual(await self.history.populate("room", self.messages), self.messages)
+
+    @override_settings(CHAT_HISTORY_LIMIT=2)
+    async def test_append_keeps_the_latest(self):
+        await self.history.populate("room", self.messages[:1])
+        for message in self.messages[1:]:
+            await self.history.append("room", message)
+        self.assertEqual(await self.history.get("room"), self.messages[1:])
+
+
+@override_settings(CHAT_FLUSH_SIZE=2, CHAT_FLUSH_INTERVAL_MS=60000, CHAT_MAX_PENDING=100)
+class ChatPipelineTests(FakeRedisMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(host_username="host")
+        with mock.patch("rooms.chat.atexit.register"):
+            self.pipeline = ChatPipeline()
+
+    async def settle(self):
+        while self.pipeline._tasks:
+            await asyncio.gather(*self.pipeline._tasks)
+
+    async def stored(self):
+        return await ChatMessage.objects.filter(room=self.room).acount()
+
+    def block_writes(self):
+        """Database writes that never finish, as when the loop stops mid-write."""
+        never = asyncio.Event()
+
+        def database_sync_to_async(func):
+            async def wait(*args):
+                await never.wait()
+
+            return wait
+
+        return mock.patch.object(chat, "database_sync_to_async", database_sync_to_async)
+
+    async def test_flushes_a_full_batch(self):
+        await self.pipeline.submit(self.room.pk, "Ann", "one")
+        await self.settle()
+        self.assertEqual(await self.stored(), 0)
+        await self.pipeline.submit(self.room.pk, "Ann", "two")
+        await self.settle()
+        self.assertEqual(await self.stored(), 2)
+
+    @override_settings(CHAT_FLUSH_INTERVAL_MS=10)
+    async def test_flushes_after_the_interval(self):
+        await self.pipeline.submit(self.room.pk, "Ann", "one")
+        await asyncio.sleep(0.05)
+        await self.settle()
+        self.assertEqual(await self.stored(), 1)
+
+    @override_settings(CHAT_MAX_PENDING=2)
+    async def test_backpressure_while_the_database_is_behind(self):
+        with self.block_writes():
+            for content in ("one", "two"):
+                await self.pipeline.submit(self.room.pk, "Ann", content)
+            await asyncio.sleep(0)
+            self.assertEqual(self.pipeline.pending, 2)
+            with self.assertRaises(ChatBackpressure):
+                await self.pipeline.submit(self.room.pk, "Ann", "three")
+            for task in self.pipeline._tasks:
+                task.cancel()
+
+    async def test_exit_writes_batches_still_being_written(self):
+        with self.block_writes():
+            for content in ("one", "two", "three"):
+                await self.pipeline.submit(self.room.pk, "Ann", content)
+            await asyncio.sleep(0)
+            for task in self.pipeline._tasks:
+                task.cancel()
+        await sync_to_async(self.pipeline._flush_at_exit)()
+        self.assertEqual(await self.stored(), 3)
+
+    async def test_exit_spills_what_cannot_be_written(self):
+        spill = fakeredis.FakeRedis(server=redis_client._clients.server)
+        await self.pipeline.submit(self.room.pk, "Ann", "one")
+        with (
+            mock.patch.object(chat, "write_messages", side_effect=DatabaseError),
+            mock.patch.object(chat.redis, "from_url", return_value=spill),
+        ):
+            await sync_to_async(self.pipeline._flush_at_exit)()
+        rows = [json.loads(row) for row in spill.lrange(chat.SPILL_KEY, 0, -1)]
+        self.assertEqual([row["content"] for row in rows], ["one"])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_consume_and_refill(self):
+        with mock.patch("rooms.throttle.time.monotonic", return_value=100.0) as monotonic:
+            bucket = throttle.TokenBucket(rate=2, burst=2)
+            self.assertEqual([bucket.consume() for _ in range(3)], [True, True, False])
+            monotonic.return_value = 100.5
+            self.assertEqual([bucket.consume() for _ in range(2)], [True, False])
+            monotonic.return_value = 200.0
+            self.assertEqual([bucket.consume() for _ in range(3)], [True, True, False])
+
+
+@override_settings(THROTTLE_ROOM_RATE=1, THROTTLE_ROOM_BURST=2)
+class RoomThrottleTests(FakeRedisMixin, SimpleTestCase):
+    async def allowed(self, at, count, room="room"):
+        with mock.patch("rooms.throttle.clock.now", return_value=at):
+            return [await throttle.allow_room(room, "chat") for _ in range(count)]
+
+    async def test_shared_room_bucket(self):
+        self.assertEqual(await self.allowed(100.0, 3), [True, True, False])
+        self.assertEqual(await self.allowed(100.0, 1, room="other"), [True])
+        self.assertEqual(await self.allowed(101.0, 2), [True, False])
+
+
+@override_settings(PLAYBACK_COALESCE_MS=20)
+class PlaybackCoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.applied = []
+        self.stored = []
+        self.allow = True
+        self.coalescer = throttle.PlaybackCoalescer(self.apply, self.store)
+
+    async def apply(self, event):
+        if self.allow:
+            self.applied.append(event)
+        return self.allow
+
+    async def store(self, event):
+        self.stored.append(event)
+
+    async def test_merges_events_within_the_window(self):
+        for event in ("play", "seek 1", "seek 2"):
+            await self.coalescer.submit(event)
+        self.assertEqual(self.applied, ["play"])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.applied, ["play", "seek 2"])
+
+    async def test_defers_a_refused_event(self):
+        self.allow = False
+        await self.coalescer.submit("play")
+        self.assertEqual(self.coalescer.pending, "play")
+        self.allow = True
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.applied, ["play"])
+        self.assertIsNone(self.coalescer.pending)
+
+    async def test_flush_stores_an_event_still_refused(self):
+        await self.coalescer.submit("play")
+        await self.coalescer.submit("pause")
+        self.allow = False
+        await self.coalescer.flush()
+        self.assertEqual((self.applied, self.stored), (["play"], ["pause"]))
+
+
+class EventLogTests(FakeRedisMixin, SimpleTestCase):
+    async def test_counter_expires_with_the_log(self):
+        await event_log.append("room", {"type": "chat_message", "content": "hi"})
+        for key in (LOG_KEY, SEQ_KEY):
+            self.assertGreater(await get_redis().ttl(key.format("room")), 0)
+
+
+@override_settings(ROOM_SHARD_SIZE=2, ROOM_SHARD_SETTLE=10)
+class RoomShardsTests(FakeRedisMixin, SimpleTestCase):
+    channels = [f"specific.inmemory!{i}" for i in range(20)]
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("rooms.shards.time")
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.time.return_value = 1000.0
+        self.time.monotonic.return_value = 1000.0
+
+    async def assigned(self, connections):
+        return {await room_shards.assign("room", channel, connections) for channel in self.channels}
+
+    async def test_small_rooms_use_one_group_without_a_lookup(self):
+        self.assertEqual(await self.assigned(2), {"room_room"})
+        self.assertFalse(await get_redis().exists(SHARDS_KEY.format("room")))
+
+    async def test_new_shards_take_members_once_settled(self):
+        self.assertEqual(await self.assigned(5), {"room_room"})
+        # Broadcasts reach the announced shards straight away.
+        self.assertEqual(
+            await RoomShards().groups("room"), ["room_room", "room_room.1", "room_room.2"]
+        )
+
+        self.time.time.return_value = 1009.0
+        self.assertEqual(await self.assigned(5), {"room_room"})
+        self.time.time.return_value = 1010.0
+        self.assertEqual(await self.assigned(5), {"room_room", "room_room.1", "room_room.2"})
+
+    async def test_growing_again_restarts_the_settle_time(self):
+        await self.assigned(3)
+        self.time.time.return_value = 1010.0
+        self.assertEqual(await self.assigned(5), {"room_room", "room_room.1"})
+        self.time.time.return_value = 1019.0
+        self.assertEqual(await self.assigned(5), {"room_room", "room_room.1"})
+
+    async def test_reset_drops_the_shards(self):
+        shards = RoomShards()
+        await self.assigned(5)
+        self.assertEqual(len(await shards.groups("room")), 3)
+
+        await shards.reset("room")
+        self.assertFalse(await get_redis().exists(SHARDS_KEY.format("room")))
+        self.assertEqual(await shards.groups("room"), ["room_room"])
+
+
+class InMemoryRoomChannelLayerTests(SimpleTestCase):
+    async def test_group_send_skips_the_excluded_channel(self):
+        layer = InMemoryRoomChannelLayer()
+        sender = await layer.new_channel()
+        other = await layer.new_channel()
+        for channel in (sender, other):
+            await layer.group_add("room", channel)
+
+        await layer.group_send("room", {"type": "hello"}, exclude=sender)
+        self.assertEqual(await layer.receive(other), {"type": "hello"})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(sender), 0.05)
+
+
+class FakeHybridRoomChannelLayer(HybridRoomChannelLayer):
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+
+    def connect(self):
+        return fakeredis.FakeAsyncRedis(server=self.server)
+
+
+class HybridRoomChannelLayerTests(SimpleTestCase):
+    @contextlib.asynccontextmanager
+    async def nodes(self):
+        """Two layers on one Redis server, standing for two processes."""
+        server = fakeredis.FakeServer()
+        layers = [FakeHybridRoomChannelLayer(server) for _ in range(2)]
+        try:
+            yield layers
+        finally:
+            for layer in layers:
+                await layer.flush()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 1)
+
+    async def assertNothingReceived(self, layer, channel):
+        # A cancelled receive forgets the channel, so this must come last.
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.2)
+
+    async def join(self, layer, group="room"):
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        return channel
+
+    async def test_group_send_reaches_members_on_every_node(self):
+        async with self.nodes() as (local, remote):
+            here, there = await self.join(local), await self.join(remote)
+
+            await local.group_send("room", {"type": "hello"})
+            self.assertEqual(await self.receive(local, here), {"type": "hello"})
+            self.assertEqual(await self.receive(remote, there), {"type": "hello"})
+
+    async def test_group_send_skips_the_excluded_channel(self):
+        async with self.nodes() as (local, remote):
+            sender, here = await self.join(local), await self.join(local)
+            there = await self.join(remote)
+
+            await local.group_send("room", {"type": "hello"}, exclude=sender)
+            await remote.group_send("room", {"type": "bye"}, exclude=there)
+            self.assertEqual(await self.receive(local, here), {"type": "hello"})
+            self.assertEqual(await self.receive(local, here), {"type": "bye"})
+            self.assertEqual(await self.receive(local, sender), {"type": "bye"})
+            self.assertEqual(await self.receive(remote, there), {"type": "hello"})
+            await self.assertNothingReceived(remote, there)
+
+    async def test_send_to_a_channel_on_another_node(self):
+        async with self.nodes() as (local, remote):
+            await local.new_channel()
+            there = await remote.new_channel()
+
+            await local.send(there, {"type": "hello"})
+            self.assertEqual(await self.receive(remote, there), {"type": "hello"})
+
+    async def test_cancelled_receive_forgets_the_channel(self):
+        async with self.nodes() as (local, remote):
+            channel = await self.join(local)
+            node = local._node()
+
+            receiver = asyncio.ensure_future(local.receive(channel))
+            await asyncio.sleep(0)
+            receiver.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await receiver
+            self.assertNotIn(channel, node.channels)
+            self.assertEqual(node.groups, {})
+            subscribers = await remote._node().redis.pubsub_numsub(node._topic("group", "room"))
+            self.assertEqual(subscribers, [(b"asgi:group:room", 0)])
+
+
+@override_settings(**TEST_SETTINGS)
+class RoomConsumerTests(FakeRedisMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(host_username="host")
+        RoomState.objects.create(room=self.room)
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f"/ws/rooms/{self.room.pk}/",
+            subprotocols=subprotocols,
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await self.receive(communicator, "snapshot")
+        return communicator
+
+    async def receive(self, communicator, event_type):
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=2))
+            if frame["type"] == event_type:
+                return frame
+
+    async def test_rejoin_announces_the_old_member_leaving(self):
+        first = await self.connect()
+        second = await self.connect()
+        await first.send_json_to({"type": "join", "username": "Ann"})
+        old_id = (await self.receive(first, "user_list"))["you"]
+        await self.receive(second, "user_joined")
+
+        await first.send_json_to({"type": "join", "username": "Ann"})
+        self.assertEqual((await self.receive(second, "user_left"))["id"], old_id)
+        new_id = (await self.receive(second, "user_joined"))["user"]["id"]
+        self.assertNotEqual(new_id, old_id)
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_video_change_ignores_invalid_urls(self):
+        sender = await self.connect()
+        viewer = await self.connect()
+        for video_url in ["https://example.com/" + "a" * 500, 42, "https://example.com/b.mp4"]:
+            await sender.send_json_to({"type": "video_change", "video_url": video_url})
+        frame = await self.receive(viewer, "video_changed")
+        self.assertEqual(frame["video_url"], "https://example.com/b.mp4")
+        self.assertEqual(
+            (await state_engine.peek(self.room.pk))["video_url"], "https://example.com/b.mp4"
+        )
+
+        await sender.disconnect()
+        await viewer.disconnect()
+
+    async def test_binary_playback_frames_carry_the_seq(self):
+        sender = await self.connect()
+        text = await self.connect()
+        binary = await self.connect(subprotocols=[codec.SUBPROTOCOL])
+
+        await sender.send_json_to({"type": "seek", "current_time": 42.5})
+        seq = (await self.receive(text, "seek"))["seq"]
+        while True:
+            output = await binary.receive_output(timeout=2)
+            if output.get("bytes"):
+                break
+        code, flags, binary_seq, position = codec.SEQUENCED.unpack(output["bytes"])
+        self.assertEqual((binary_seq, position), (seq, 42.5))
+
+        for communicator in (sender, text, binary):
+            await communicator.disconnect()
+
+    async def test_ping_is_answered_with_the_server_time(self):
+        communicator = await self.connect()
+        with mock.patch("rooms.consumers.now", return_value=1000.5):
+            await communicator.send_json_to({"type": "ping", "client_time": 999.25})
+            pong = await self.receive(communicator, "pong")
+        self.assertEqual(pong, {"type": "pong", "client_time": 999.25, "server_time": 1000.5})
+
+        await communicator.disconnect()
+
+
+class ClockTests(SimpleTestCase):
+    def test_playing_position_advances_with_the_rate(self):
+        self.assertEqual(clock.extrapolate(10.0, True, anchored_at=100.0, at=104.0), 14.0)
+        self.assertEqual(clock.extrapolate(10.0, True, 100.0, rate=1.5, at=104.0), 16.0)
+
+    def test_paused_position_stays_put(self):
+        self.assertEqual(clock.extrapolate(10.0, False, anchored_at=100.0, at=104.0), 10.0)
+        self.assertEqual(clock.extrapolate(10.0, True, anchored_at=None, at=104.0), 10.0)
+
+    def test_anchor_in_the_future_does_not_rewind(self):
+        self.assertEqual(clock.extrapolate(10.0, True, anchored_at=105.0, at=104.0), 10.0)
+
+    def test_live_state_extrapolates_to_its_server_time(self):
+        state = {"current_time": 10.0, "is_playing": True, "playback_rate": 2.0, "anchored_at": 100}
+        with mock.patch.object(clock, "now", return_value=103.0):
+            self.assertEqual(
+                clock.live_state(state),
+                {
+                    "current_time": 16.0,
+                    "is_playing": True,
+                    "playback_rate": 2.0,
+                    "server_time": 103.0,
+                },
+            )
+
+
+class DatabasePoolTests(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.pool = db.PoolExecutor(max_workers=1, initializer=db._init_thread)
+        self.addCleanup(self.pool.shutdown)
+        self.addCleanup(self.release.set)
+
+    def test_calls_count_until_their_thread_is_done(self):
+        self.pool.submit(self.release.wait)
+        waiting = self.pool.submit(self.release.wait)
+        self.assertEqual(self.pool.in_flight, 2)
+        waiting.cancel()
+        self.assertEqual(self.pool.in_flight, 1)
+        self.release.set()
+        self.pool.shutdown()
+        self.assertEqual(self.pool.in_flight, 0)
+
+    @override_settings(DB_POOL_SIZE=1, DB_POOL_MAX_QUEUE=1)
+    async def test_rejects_calls_once_the_queue_is_full(self):
+        self.pool.submit(self.release.wait)
+        self.pool.submit(self.release.wait)
+        with mock.patch.object(db, "executor", self.pool):
+            with self.assertRaises(db.DatabaseBusy):
+                await db.database_sync_to_async(dict, executor=self.pool)()
+
+    @override_settings(DB_STATEMENT_TIMEOUT_MS=30000)
+    def test_statement_timeout_only_on_pool_connections(self):
+        connection = mock.MagicMock(vendor="postgresql")
+        db._set_statement_timeout(None, connection)
+        connection.cursor.assert_not_called()
+
+        self.pool.submit(db._set_statement_timeout, None, connection).result()
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with(mock.ANY, ["30000"])
+
+
+@override_settings(**TEST_SETTINGS)
+class SnapshotTests(TestCase):
+    def setUp(self):
+        video = Video.objects.create(title="Film", source_url="https://example.com/film.mp4")
+        self.room = Room.objects.create(host_username="host", video=video)
+        RoomState.objects.create(room=self.room, current_time=12.5, is_playing=True)
+        for i in range(3):
+            ChatMessage.objects.create(room=self.room, username="Ann", content=f"message {i}")
+        self.consumer = RoomConsumer()
+        self.consumer.room_id = self.room.pk
+
+    def load_snapshot(self, **kwargs):
+        # The undecorated method, run on this thread inside the test transaction.
+        return RoomConsumer.__dict__["load_snapshot"].func(self.consumer, **kwargs)
+
+    def test_room_state_and_video_in_one_query_messages_in_another(self):
+        with self.assertNumQueries(2):
+            snapshot = self.load_snapshot()
+        self.assertEqual(snapshot["state"]["current_time"], 12.5)
+        self.assertTrue(snapshot["state"]["is_playing"])
+        self.assertEqual(snapshot["video"]["title"], "Film")
+        self.assertEqual(
+            [message["content"] for message in snapshot["messages"]],
+            ["message 0", "message 1", "message 2"],
+        )
+
+    def test_without_messages(self):
+        with self.assertNumQueries(1):
+            snapshot = self.load_snapshot(with_messages=False)
+        self.assertIsNone(snapshot["messages"])
+
+
+@override_settings(**TEST_SETTINGS)
+class LiveStateOverwriteTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(host_username="host", video_url="https://example.com/a.mp4")
+        self.state = RoomState.objects.create(room=self.room, current_time=5.0)
+        # Viewers are connected, so the room has live state in Redis.
+        async_to_sync(state_engine.get)(
+            self.room.pk,
+            initial={"current_time": 5.0, "is_playing": True, "video_url": self.room.video_url},
+        )
+
+    def peek(self):
+        return async_to_sync(state_engine.peek)(self.room.pk)
+
+    async def dirty(self):
+        return await get_redis().sismember(DIRTY_KEY, str(self.room.pk))
+
+    def test_room_patch_updates_the_live_video(self):
+        new_url = "https://example.com/b.mp4"
+        response = self.client.patch(
+            f"/api/rooms/{self.room.pk}/", {"video_url": new_url}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.client.get(f"/api/rooms/{self.room.pk}/").json()["video_url"], new_url
+        )
+        self.assertEqual(self.peek()["video_url"], new_url)
+        # The database already holds the new value.
+        self.assertFalse(async_to_sync(self.dirty)())
+
+    def test_admin_state_edit_updates_the_live_state(self):
+        self.state.current_time = 42.0
+        self.state.is_playing = False
+        RoomStateAdmin(RoomState, admin.site).save_model(None, self.state, None, change=True)
+        live = self.peek()
+        self.assertEqual(live["current_time"], 42.0)
+        self.assertFalse(live["is_playing"])
+
+
+class StateWriteTests(TestCase):
+    def test_state_and_video_are_written_together(self):
+        room = Room.objects.create(host_username="host", video_url="https://example.com/a.mp4")
+        RoomState.objects.create(room=room, current_time=5.0)
+        update_rows = RoomStateEngine.__dict__["_update_rows"].func
+        with mock.patch.object(Room.objects, "filter", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                update_rows(state_engine, room.pk, {"current_time": 9.0, "video_url": "x"})
+        self.assertEqual(RoomState.objects.get(room=room).current_time, 5.0)
+
+
+class ChatMessageAdminTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(host_username="host")
+        self.message = ChatMessage.objects.create(room=self.room, username="Ann", content="hello")
+        ChatMessage.objects.create(room=Room.objects.create(host_username="other"), content="hi")
+        self.admin = admin.site._registry[ChatMessage]
+
+    def search(self, term):
+        results, _ = self.admin.get_search_results(None, ChatMessage.objects.all(), term)
+        return list(results)
+
+    def test_search_by_room_id_only(self):
+        self.assertEqual(self.search(str(self.room.pk)), [self.message])
+        self.assertEqual(self.search("hello"), [])
+        self.assertEqual(len(self.search("")), 2)
+
+    def test_room_search_by_id_only(self):
+        room_admin = admin.site._registry[Room]
+        results, _ = room_admin.get_search_results(None, Room.objects.all(), str(self.room.pk))
+        self.assertEqual(list(results), [self.room])
+        results, _ = room_admin.get_search_results(None, Room.objects.all(), "host")
+        self.assertEqual(list(results), [])
+
+    def test_str_needs_no_query(self):
+        message = ChatMessage.objects.get(pk=self.message.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(message), f"Ann in Room {self.room.pk}: hello")
+
+
+@override_settings(**TEST_SETTINGS)
+class ReaperTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cutoff = reaper.days_ago(30)
+        old = reaper.days_ago(60)
+        self.rooms = [Room.objects.create(host_username=f"host {i}") for i in range(2)]
+        for room in self.rooms:
+            RoomState.objects.create(room=room)
+            for i in range(3):
+                ChatMessage.objects.create(
+                    room=room, username="Ann", content=str(i), created_at=old
+                )
+        Room.objects.update(created_at=old)
+        RoomState.objects.update(last_updated=old)
+        self.directory = tempfile.mkdtemp()
+
+    def reap(self):
+        archive = reaper.Archive(self.directory, "rooms")
+        totals = [sum(counts) for counts in zip(*reaper.reap_rooms(self.cutoff, 2, archive))]
+        archive.close()
+        with gzip.open(archive.path, "rt") as lines:
+            return totals, [json.loads(line) for line in lines]
+
+    def test_archives_and_deletes_chat_before_rooms(self):
+        (rooms, messages), records = self.reap()
+        self.assertEqual((rooms, messages), (2, 6))
+        self.assertFalse(Room.objects.exists())
+        self.assertFalse(ChatMessage.objects.exists())
+        kinds = [record["kind"] for record in records]
+        self.assertEqual((kinds.count("room"), kinds.count("message")), (2, 6))
+
+    def test_room_used_again_while_reaped_is_kept(self):
+        woken = self.rooms[0]
+        archive_messages = reaper.archive_messages
+
+        def archive_then_wake(*args):
+            count = archive_messages(*args)
+            ChatMessage.objects.create(room=woken, username="Bob", content="back")
+            return count
+
+        with mock.patch.object(reaper, "archive_messages", archive_then_wake):
+            (rooms, messages), records = self.reap()
+
+        self.assertEqual((rooms, messages), (1, 3))
+        self.assertEqual(list(Room.objects.all()), [woken])
+        self.assertEqual(
+            list(ChatMessage.objects.values_list("content", flat=True)), ["0", "1", "2", "back"]
+        )
+        self.assertEqual(records[-1], {"kind": "kept", "id": str(woken.pk)})
+
+
+@override_settings(**TEST_SETTINGS)
+class VideoPaginationTests(TestCase):
+    def setUp(self):
+        # Created within one millisecond of each other.
+        start = timezone.now().replace(microsecond=1000)
+        for offset, title in enumerate(["first", "second", "third"]):
+            video = Video.objects.create(title=title)
+            Video.objects.filter(pk=video.pk).update(
+                created_at=start + timedelta(microseconds=offset)
+            )
+
+    def titles(self, ordering):
+        titles = []
+        url = f"/api/videos/?ordering={ordering}&limit=1"
+        while url and len(titles) < 5:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            titles += [video["title"] for video in response.json()["results"]]
+            url = response.json()["next"]
+        return titles
+
+    def test_ascending_datetime_cursor_keeps_microseconds(self):
+        self.assertEqual(self.titles("created_at"), ["first", "second", "third"])
+
+    def test_descending_datetime_cursor_keeps_microseconds(self):
+        self.assertEqual(self.titles("-created_at"), ["third", "second", "first"])
+
+    def test_invalid_cursor_is_a_bad_request(self):
+        response = self.client.get("/api/videos/?cursor=garbage")
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(**TEST_SETTINGS)
+class ChatMessagePaginationTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(host_username="host")
+        for i in range(5):
+            ChatMessage.objects.create(room=self.room, username="Ann", content=f"message {i}")
+        # The same created_at throughout, so pages are split on id alone.
+        ChatMessage.objects.update(created_at=timezone.now())
+        self.messages = sorted(ChatMessage.objects.all(), key=lambda message: message.pk)
+        self.url = f"/api/rooms/{self.room.pk}/messages/?limit=2"
+
+    def get(self, **params):
+        query = "".join(f"&{name}={value}" for name, value in params.items())
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def ids(self, page):
+        return [message["id"] for message in page["results"]]
+
+    def test_before_walks_back_through_equal_timestamps(self):
+        page = self.get()
+        ids = self.ids(page)
+        while page["before"]:
+            page = self.get(before=page["before"])
+            ids = self.ids(page) + ids
+        self.assertEqual(ids, [str(message.pk) for message in self.messages])
+
+    def test_after_walks_forward_through_equal_timestamps(self):
+        page = {"after": KeysetPagination().encode_cursor(self.messages[0]), "has_newer": True}
+        ids = []
+        while page["has_newer"]:
+            page = self.get(after=page["after"])
+            ids += self.ids(page)
+        self.assertEqual(ids, [str(message.pk) for message in self.messages[1:]])
+
+    def test_invalid_cursor_is_a_bad_request(self):
+        for param in ("before", "after"):
+            for cursor in ("garbage", "bm90LWEtZGF0ZXxub3QtYS11dWlk"):
+                response = self.client.get(f"{self.url}&{param}={cursor}")
+                self.assertEqual(response.status_code, 400, (param, cursor))
+
+
+@override_settings(**TEST_SETTINGS)
+class ChatExportTests(TestCase):
+    async def test_export_streams_from_an_async_iterator(self):
+        room = await Room.objects.acreate(host_username="host")
+        for i in range(3):
+            await ChatMessage.objects.acreate(room=room, username="Ann", content=f"message {i}")
+
+        response = await self.async_client.get(f"/api/rooms/{room.pk}/messages/export/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row["content"] for row in rows], ["message 0", "message 1", "message 2"])
+
+
+@override_settings(**TEST_SETTINGS)
+class RoomStateViewTests(FakeRedisMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(host_username="host")
+        RoomState.objects.create(room=self.room, current_time=5.0)
+        self.url = f"/api/rooms/{self.room.pk}/state/"
+
+    def test_not_modified_until_the_state_changes(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.patch(self.url, {"current_time": 42.0}, content_type="application/json")
+        response = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["current_time"], 42.0)
+
+    def test_rejects_invalid_playback_values(self):
+        for data in [
+            {"current_time": -1},
+            {"current_time": "nan"},
+            {"playback_rate": 0},
+            {"playback_rate": -1},
+            {"playback_rate": 100},
+            {"playback_rate": "inf"},
+        ]:
+            response = self.client.patch(self.url, data, content_type="application/json")
+            self.assertEqual(response.status_code, 400, data)
+
+        response = self.client.patch(
+            self.url, {"current_time": 0, "playback_rate": 2}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["playback_rate"], 2.0)
+
+    async def test_long_poll_times_out_unchanged(self):
+        etag = (await self.async_client.get(self.url))["ETag"]
+        start = time.monotonic()
+        response = await self.async_client.get(
+            f"{self.url}?wait=0.2", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    async def test_long_poll_wakes_on_a_broadcast(self):
+        await state_engine.get(self.room.pk, initial={"current_time": 5.0, "is_playing": False})
+        etag = (await self.async_client.get(self.url))["ETag"]
+
+        async def seek():
+            # As a consumer does it; the in-memory layer only wakes receivers on its own loop.
+            await asyncio.sleep(0.1)
+            await state_engine.update(self.room.pk, current_time=42.0)
+            payload = {"type": "seek", "current_time": 42.0}
+            await event_log.publish(get_channel_layer(), self.room.pk, payload)
+
+        start = time.monotonic()
+        response, _ = await asyncio.gather(
+            self.async_client.get(f"{self.url}?wait=5", headers={"If-None-Match": etag}), seek()
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(metrics, "registry", [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_room_series_dropped_at_zero(self):
+        gauge = metrics.Gauge("connections", "Connections", ["room"])
+        gauge.inc("a")
+        gauge.inc("a")
+        gauge.dec("a")
+        self.assertEqual(gauge.snapshot(), {("a",): 1})
+        gauge.dec("a")
+        self.assertEqual(gauge.snapshot(), {})
+
+    def test_samples_are_read_from_a_copy(self):
+        # As when the event loop updates a metric while /metrics renders it.
+        counter = metrics.Counter("sent", "Sent", ["type"])
+        counter.inc("chat")
+        samples = counter.samples()
+        next(samples)
+        counter.inc("seek")
+        self.assertEqual(list(samples), [])
+
+        histogram = metrics.Histogram("duration", "Duration", ["type"])
+        histogram.observe(0.01, "chat")
+        samples = histogram.samples()
+        next(samples)
+        histogram.observe(0.01, "seek")
+        self.assertTrue(all(labels == ("chat",) for _, labels, _, _ in samples))
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN="secret")
+class MetricsViewTests(SimpleTestCase):
+    def test_requires_the_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_not_served_without_a_token(self):
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer "})
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,142 @@
+"""
+Rate limiting and coalescing of client events.
+
+Every connection has an in-process token bucket; every room has one kept in
+Redis so it is shared by all workers. Playback events (play/pause/seek) from
+a connection are coalesced: the first one in a quiet period goes out straight
+away and anything arriving within ``PLAYBACK_COALESCE_MS`` of it is merged
+into a single latest-wins event sent when the window closes. Playback is never
+dropped, only merged or deferred, so the room always ends up in the state the
+client last asked for; an event still refused when the connection closes is
+stored without a broadcast, and viewers pick it up from the next tick.
+
+Counts of dropped, merged, deferred and stored events are kept in ``events``.
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from rooms import clock
+from rooms.redis_client import get_redis
+
+ROOM_BUCKET_KEY = "tandem:room:{}:throttle:{}"
+
+ROOM_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+events = Counter()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def channel_bucket():
+    return TokenBucket(settings.THROTTLE_CHANNEL_RATE, settings.THROTTLE_CHANNEL_BURST)
+
+
+async def allow_room(room_id, kind):
+    """Take a token from the room's shared ``kind`` bucket. Returns False if it is empty."""
+    allowed = await get_redis().eval(
+        ROOM_BUCKET_SCRIPT,
+        1,
+        ROOM_BUCKET_KEY.format(room_id, kind),
+        settings.THROTTLE_ROOM_RATE,
+        settings.THROTTLE_ROOM_BURST,
+        clock.now(),
+    )
+    return bool(allowed)
+
+
+class PlaybackCoalescer:
+    """
+    Latest-wins coalescing of one connection's playback events. ``apply`` is
+    awaited with each event that goes out and returns False to have it
+    deferred to the next window. ``store`` is awaited with the last event if
+    ``apply`` refuses it on ``flush``, when there is no next window.
+    """
+
+    def __init__(self, apply, store):
+        self.apply = apply
+        self.store = store
+        self.pending = None
+        self._quiet_at = 0.0
+        self._timer = None
+        self._task = None
+
+    @property
+    def window(self):
+        return settings.PLAYBACK_COALESCE_MS / 1000
+
+    async def submit(self, event):
+        loop = asyncio.get_running_loop()
+        if self.pending is None and self._timer is None and loop.time() >= self._quiet_at:
+            self._quiet_at = loop.time() + self.window
+            if await self.apply(event):
+                return
+            events["deferred"] += 1
+        elif self.pending is not None:
+            events["merged"] += 1
+        self.pending = event
+        self._schedule(loop)
+
+    async def flush(self):
+        """Apply the pending event now, e.g. when the connection closes."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        event, self.pending = self.pending, None
+        if event is not None and not await self.apply(event):
+            events["stored"] += 1
+            await self.store(event)
+
+    def _schedule(self, loop):
+        if self._timer is None:
+            self._timer = loop.call_at(max(self._quiet_at, loop.time()), self._fire)
+
+    def _fire(self):
+        self._timer = None
+        self._task = asyncio.get_running_loop().create_task(self._apply_pending())
+
+    async def _apply_pending(self):
+        event, self.pending = self.pending, None
+        if event is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._quiet_at = loop.time() + self.window
+        if not await self.apply(event):
+            events["deferred"] += 1
+            if self.pending is None:
+                self.pending = event
+            self._schedule(loop)
@@ -1,12 +1,14 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from rooms.views import RoomViewSet, VideoViewSet
+from rooms.views import RoomViewSet, VideoViewSet, room_state
 
 router = DefaultRouter()
 router.register(r'rooms', RoomViewSet, basename='room')
 router.register(r'videos', VideoViewSet, basename='video')
 
 urlpatterns = [
+    # Ahead of the router so GETs on the state action can long-poll.
+    path('rooms/<uuid:pk>/state/', room_state),
     path('', include(router.urls)),
 ]
@@ -1,18 +1,90 @@
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.views.decorators.csrf import csrf_exempt
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from rooms.models import Room, RoomState, Video
+from rooms.cache import catalog_version, get_room, invalidate_room
+from rooms.events import event_log
+from rooms.models import ChatMessage, Room, RoomState, Video
+from rooms.pagination import KeysetPagination, OrderingCursorPagination
+from rooms.search import VideoSearchFilter
 from rooms.serializers import (
+    ChatMessageSerializer,
     RoomSerializer,
     RoomCreateSerializer,
     RoomStateSerializer,
     VideoSerializer,
 )
+from rooms.shards import group_name
+from rooms.state import state_engine
+
+PLAYBACK_KINDS = ("play", "pause", "seek")
+
+
+async def ndjson_lines(queryset, chunk_size=2000):
+    async for row in queryset.aiterator(chunk_size=chunk_size):
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+def apply_live_state(room):
+    """Overlay the live playback state held by the state engine onto ``room``."""
+    live = async_to_sync(state_engine.peek)(room.pk)
+    if not live:
+        return room
+    if "video_url" in live:
+        room.video_url = live["video_url"]
+    if hasattr(room, "state"):
+        for name in ("current_time", "is_playing", "playback_rate"):
+            if name in live:
+                setattr(room.state, name, live[name])
+        if "anchored_at" in live:
+            room.state.anchored_at = datetime.fromtimestamp(live["anchored_at"], tz=dt_timezone.utc)
+    return room
+
+
+def etag_matches(request, etag):
+    """If-None-Match uses weak comparison, so ``W/`` prefixes are ignored."""
+    tags = parse_etags(request.headers.get("If-None-Match", ""))
+    return "*" in tags or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+
+def digest(*parts):
+    return hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()[:20]
+
+
+def state_etag(request, state):
+    # Weak: the body extrapolates current_time to the moment it is rendered, but any two
+    # bodies with the same anchor describe the same playback.
+    return 'W/"%s"' % digest(
+        request.accepted_renderer.format,
+        repr(state.current_time),
+        state.is_playing,
+        repr(state.playback_rate),
+        state.anchored_at.timestamp(),
+        state.last_updated.timestamp(),
+    )
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
 
 class RoomViewSet(viewsets.ModelViewSet):
-    queryset = Room.objects.all()
+    queryset = Room.objects.select_related("state", "video").defer("video__search_vector")
+    pagination_class = OrderingCursorPagination
+    ordering = ["-created_at"]
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -27,30 +99,142 @@ class RoomViewSet(viewsets.ModelViewSet):
         response_serializer = RoomSerializer(room)
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
+    def get_cached_object(self):
+        room = get_room(self.kwargs[self.lookup_field])
+        if room is None:
+            raise Http404
+        self.check_object_permissions(self.request, room)
+        return room
+
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
+        instance = apply_live_state(self.get_cached_object())
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        room = serializer.instance
+        invalidate_room(room.pk)
+        if "video_url" in serializer.validated_data:
+            # Live state in Redis overrides the row until it is flushed, so update it too.
+            async_to_sync(state_engine.overwrite)(room.pk, room=room)
+            payload = {"type": "video_changed", "video_url": room.video_url or ""}
+            async_to_sync(event_log.publish)(get_channel_layer(), room.pk, payload)
+
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        super().perform_destroy(instance)
+        invalidate_room(pk)
+
     @action(detail=True, methods=['get', 'patch'], url_path='state')
     def room_state(self, request, pk=None):
-        room = self.get_object()
-
         if request.method == 'GET':
-            serializer = RoomStateSerializer(room.state)
-            return Response(serializer.data)
+            room = self.get_cached_object()
+            state = apply_live_state(room).state
+            etag = state_etag(request, state)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            serializer = RoomStateSerializer(state)
+            return Response(serializer.data, headers={"ETag": etag})
 
         elif request.method == 'PATCH':
+            room = self.get_object()
             serializer = RoomStateSerializer(room.state, data=request.data, partial=True)
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            state = serializer.save()
+            invalidate_room(room.pk)
+            async_to_sync(state_engine.overwrite)(room.pk, state=state)
+            # Let connected viewers and long-polling clients know about the new state.
+            payload = {
+                "type": "play" if state.is_playing else "pause",
+                "current_time": state.current_time,
+            }
+            async_to_sync(event_log.publish)(get_channel_layer(), room.pk, payload)
             return Response(serializer.data)
 
+    @action(detail=True, methods=['get'], url_path='messages')
+    def messages(self, request, pk=None):
+        room = self.get_object()
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(
+            ChatMessage.objects.filter(room=room), request, view=self
+        )
+        serializer = ChatMessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'], url_path='messages/export')
+    def export_messages(self, request, pk=None):
+        room = self.get_object()
+        rows = (
+            ChatMessage.objects.filter(room=room)
+            .order_by("created_at", "id")
+            .values("id", "username", "content", "created_at")
+        )
+        # An async iterator is streamed by the ASGI handler chunk by chunk; a sync one
+        # would be read into a list first.
+        response = StreamingHttpResponse(ndjson_lines(rows), content_type="application/x-ndjson")
+        response["Content-Disposition"] = f'attachment; filename="room-{room.pk}-chat.jsonl"'
+        return response
+
 
 class VideoViewSet(viewsets.ModelViewSet):
-    queryset = Video.objects.all()
+    queryset = Video.objects.defer("search_vector")
     serializer_class = VideoSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = OrderingCursorPagination
+    # Search runs last so its relevance ordering wins over the default ordering.
+    filter_backends = [filters.OrderingFilter, VideoSearchFilter]
     search_fields = ["title", "description"]
     ordering_fields = ["created_at", "year", "rating", "title"]
     ordering = ["-created_at"]
+
+    def list(self, request, *args, **kwargs):
+        etag = '"%s"' % digest(
+            catalog_version(), request.accepted_renderer.format, request.get_full_path()
+        )
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
+
+room_state_view = RoomViewSet.as_view({"get": "room_state", "patch": "room_state"})
+
+
+@csrf_exempt
+async def room_state(request, pk):
+    """
+    The room state endpoint. A GET with ``?wait=<seconds>`` and an If-None-Match
+    that matches the current state is held until the state changes or the wait
+    (capped at ``ROOM_STATE_MAX_WAIT``) runs out, then answered as usual.
+    """
+    if request.method != "GET" or "wait" not in request.GET:
+        return await sync_to_async(room_state_view)(request, pk=pk)
+
+    try:
+        wait = min(max(float(request.GET["wait"]), 0.0), settings.ROOM_STATE_MAX_WAIT)
+    except ValueError:
+        wait = 0.0
+
+    # Subscribe before reading the state so a change in between is not missed.
+    channel_layer = get_channel_layer()
+    channel = await channel_layer.new_channel()
+    group = group_name(pk)
+    await channel_layer.group_add(group, channel)
+    try:
+        response = await sync_to_async(room_state_view)(request, pk=pk)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while response.status_code == status.HTTP_304_NOT_MODIFIED:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(channel_layer.receive(channel), remaining)
+            except asyncio.TimeoutError:
+                break
+            if message.get("kind") in PLAYBACK_KINDS:
+                response = await sync_to_async(room_state_view)(request, pk=pk)
+        return response
+    finally:
+        await channel_layer.group_discard(group, channel)
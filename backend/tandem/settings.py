@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "channels",
     "rest_framework",
     "drf_spectacular",
@@ -96,7 +97,7 @@ if os.getenv("DATABASE_URL"):
     DATABASES = {
         "default": dj_database_url.config(
             default=os.getenv("DATABASE_URL"),
-            conn_max_age=600,
+            conn_max_age=int(os.getenv("DB_CONN_MAX_AGE", "0")),
             conn_health_checks=True,
         )
     }
@@ -109,9 +110,26 @@ else:
             "PASSWORD": os.getenv("DB_PASSWORD", "postgres"),
             "HOST": os.getenv("DB_HOST", "localhost"),
             "PORT": os.getenv("DB_PORT", "5432"),
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "0")),
+            "CONN_HEALTH_CHECKS": True,
         }
     }
 
+# Under ASGI every request runs on a new thread, so persistent connections are not reused
+# there (DB_CONN_MAX_AGE defaults to 0). Realtime code uses a pool of DB_POOL_SIZE threads
+# that keep their connections for DB_POOL_CONN_MAX_AGE seconds; see rooms.db. Per worker
+# process, DB_POOL_SIZE plus concurrent REST requests must fit in Postgres max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_CONN_MAX_AGE = int(os.getenv("DB_POOL_CONN_MAX_AGE", "600"))
+DB_POOL_MAX_QUEUE = int(os.getenv("DB_POOL_MAX_QUEUE", "500"))
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "10"))
+# Statement timeout of the pool's connections only; migrations and maintenance commands run
+# without one. 0 disables it.
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+if "postgresql" in DATABASES["default"]["ENGINE"]:
+    DATABASES["default"].setdefault("OPTIONS", {})["connect_timeout"] = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -158,24 +176,87 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 ASGI_APPLICATION = "tandem.asgi.application"
 
-if os.getenv("REDIS_URL"):
-    CHANNEL_LAYERS = {
-        "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
-            "CONFIG": {
-                "hosts": [os.getenv("REDIS_URL")],
-            },
-        },
-    }
-else:
-    CHANNEL_LAYERS = {
-        "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
-            "CONFIG": {
-                "hosts": [(os.getenv("REDIS_HOST", "localhost"), int(os.getenv("REDIS_PORT", "6379")))],
-            },
+REDIS_URL = os.getenv(
+    "REDIS_URL",
+    f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', '6379')}/0",
+)
+
+CHANNEL_LAYERS = {
+    "default": {
+        # rooms.layers.HybridRoomChannelLayer delivers to consumers in the same process
+        # from memory and uses Redis pub/sub only between processes.
+        "BACKEND": os.getenv("CHANNEL_LAYER_BACKEND", "rooms.layers.RoomChannelLayer"),
+        "CONFIG": {
+            "hosts": [REDIS_URL],
         },
-    }
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "tandem",
+    },
+}
+
+# Seconds a room (with its state and video) stays cached for the REST API.
+ROOM_CACHE_TTL = int(os.getenv("ROOM_CACHE_TTL", "60"))
+# Longest a long-polling GET on the room state endpoint is held open, in seconds.
+ROOM_STATE_MAX_WAIT = float(os.getenv("ROOM_STATE_MAX_WAIT", "30"))
+
+# Seconds between write-behind flushes of live room state to the database.
+ROOM_STATE_FLUSH_INTERVAL = float(os.getenv("ROOM_STATE_FLUSH_INTERVAL", "5"))
+# Seconds live room state is kept in Redis after the last update or connection heartbeat.
+ROOM_STATE_TTL = int(os.getenv("ROOM_STATE_TTL", "3600"))
+
+# Seconds a connected user stays listed without a heartbeat from their worker.
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "30"))
+
+# Seconds between playback "tick" frames pushed to clients of playing rooms.
+PLAYBACK_TICK_INTERVAL = float(os.getenv("PLAYBACK_TICK_INTERVAL", "5"))
+
+# Chat messages are written in batches of CHAT_FLUSH_SIZE, or CHAT_FLUSH_INTERVAL_MS
+# after the first buffered message. Senders are pushed back once CHAT_MAX_PENDING messages
+# are buffered or being written.
+CHAT_FLUSH_SIZE = int(os.getenv("CHAT_FLUSH_SIZE", "100"))
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "250"))
+CHAT_MAX_PENDING = int(os.getenv("CHAT_MAX_PENDING", "5000"))
+
+# Number of recent messages sent on connect, cached per room in Redis for CHAT_HISTORY_TTL
+# seconds after the last message.
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "50"))
+CHAT_HISTORY_TTL = int(os.getenv("CHAT_HISTORY_TTL", "86400"))
+
+# Room broadcasts are kept in a per-room log of about EVENT_LOG_LENGTH entries, expiring
+# EVENT_LOG_TTL seconds after the last one, so reconnecting clients can catch up from it.
+EVENT_LOG_LENGTH = int(os.getenv("EVENT_LOG_LENGTH", "500"))
+EVENT_LOG_TTL = int(os.getenv("EVENT_LOG_TTL", "3600"))
+
+# The reap_rooms command archives to ROOM_ARCHIVE_DIR and deletes rooms idle for
+# ROOM_IDLE_DAYS, and chat older than CHAT_RETENTION_DAYS (0 keeps chat of live rooms).
+ROOM_IDLE_DAYS = float(os.getenv("ROOM_IDLE_DAYS", "30"))
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "0"))
+ROOM_ARCHIVE_DIR = os.getenv("ROOM_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+
+# Per-connection token bucket for chat, joins, renames and video changes (events per second
+# and burst), and per-room buckets shared by all workers for chat and playback broadcasts.
+THROTTLE_CHANNEL_RATE = float(os.getenv("THROTTLE_CHANNEL_RATE", "5"))
+THROTTLE_CHANNEL_BURST = int(os.getenv("THROTTLE_CHANNEL_BURST", "10"))
+THROTTLE_ROOM_RATE = float(os.getenv("THROTTLE_ROOM_RATE", "20"))
+THROTTLE_ROOM_BURST = int(os.getenv("THROTTLE_ROOM_BURST", "40"))
+# Window within which a connection's play/pause/seek events are merged into the latest one.
+PLAYBACK_COALESCE_MS = int(os.getenv("PLAYBACK_COALESCE_MS", "150"))
+
+# Rooms are split into one channel group per ROOM_SHARD_SIZE connections. A new shard
+# takes members ROOM_SHARD_SETTLE seconds after it is created, once every worker sends to it.
+ROOM_SHARD_SIZE = int(os.getenv("ROOM_SHARD_SIZE", "500"))
+ROOM_SHARD_SETTLE = float(os.getenv("ROOM_SHARD_SETTLE", "2"))
+
+# Expose process metrics in the Prometheus text format on /metrics.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "False") == "True"
+# Bearer token scrapers must send; metrics are not served without one.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 CORS_ALLOWED_ORIGINS = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:3000").split(",")
 CORS_ALLOW_CREDENTIALS = True
@@ -191,6 +272,14 @@ SPECTACULAR_SETTINGS = {
     "SERVE_INCLUDE_SCHEMA": False,
 }
 
+# Log output: "verbose" for human-readable lines, "json" for one JSON object per record.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "verbose")
+ROOMS_LOG_LEVEL = os.getenv("ROOMS_LOG_LEVEL", "INFO")
+# Per-room sampling of INFO/DEBUG records from the realtime code: sustained records per
+# second and burst size for each room and message. Warnings and errors are never sampled.
+LOG_ROOM_RATE = float(os.getenv("LOG_ROOM_RATE", "5"))
+LOG_ROOM_BURST = int(os.getenv("LOG_ROOM_BURST", "20"))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -199,17 +288,32 @@ LOGGING = {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'rooms.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'room_rate': {
+            '()': 'rooms.log.RoomRateFilter',
+            'rate': LOG_ROOM_RATE,
+            'burst': LOG_ROOM_BURST,
+        },
     },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
-            'formatter': 'verbose',
+            'formatter': LOG_FORMAT,
+        },
+        'rooms': {
+            'class': 'logging.StreamHandler',
+            'formatter': LOG_FORMAT,
+            'filters': ['room_rate'],
         },
     },
     'loggers': {
         'rooms': {
-            'handlers': ['console'],
-            'level': 'INFO',
+            'handlers': ['rooms'],
+            'level': ROOMS_LOG_LEVEL,
             'propagate': False,
         },
         'daphne': {
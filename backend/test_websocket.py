@@ -1,46 +1,217 @@
+"""
+Load generator for the room WebSocket.
+
+Opens many simulated viewers across many rooms, has a few of them per room
+drive a mix of play/pause/seek/chat events, and reports connect latency,
+fan-out latency (from an event being sent to each other viewer receiving
+it), throughput and errors. Run it against a local Daphne backed by Redis:
+
+    daphne -b 0.0.0.0 -p 8000 tandem.asgi:application
+    python test_websocket.py --rooms 20 --viewers 50 --duration 60
+
+Rooms are created through the REST API unless ``--room`` ids are given.
+Thousands of connections need a raised open-files limit (``ulimit -n``).
+"""
+
+import argparse
 import asyncio
-import websockets
 import json
+import random
+import time
+import urllib.request
+import uuid
+from collections import Counter
+
+import websockets
+
+EVENTS = ("play", "pause", "seek", "chat")
+# Frame type each client event is broadcast as.
+BROADCAST_TYPES = {"play": "play", "pause": "pause", "seek": "seek", "chat": "chat_message"}
+
+
+class Stats:
+    def __init__(self):
+        self.connect_latencies = []
+        self.fanout_latencies = []
+        self.connected = 0
+        self.sent = 0
+        self.received = 0
+        self.errors = Counter()
+        self.pending = {}
+
+    def expect(self, key):
+        self.pending[key] = time.perf_counter()
+
+    def observe(self, key):
+        sent_at = self.pending.get(key)
+        if sent_at is not None:
+            self.fanout_latencies.append(time.perf_counter() - sent_at)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def parse_mix(value):
+    weights = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in EVENTS:
+            raise argparse.ArgumentTypeError(f"unknown event {name!r}, expected one of {EVENTS}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def create_room(api_url):
+    request = urllib.request.Request(
+        f"{api_url}/rooms/",
+        data=json.dumps({"host_username": "loadtest"}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["id"]
+
+
+def frame_key(room_id, frame):
+    frame_type = frame.get("type")
+    if frame_type in ("play", "pause", "seek"):
+        return room_id, frame_type, frame.get("current_time")
+    if frame_type == "chat_message":
+        return room_id, frame_type, frame.get("content")
+    return None
+
+
+def next_event(room_id, mix):
+    event = random.choices(list(mix), weights=list(mix.values()))[0]
+    if event == "chat":
+        content = f"load {uuid.uuid4().hex}"
+        return {"type": "chat", "content": content}, (room_id, "chat_message", content)
+    # A random position doubles as a unique id for matching the broadcast.
+    position = round(random.uniform(0, 7200), 6)
+    message = {"type": event, "current_time": position}
+    if event == "seek":
+        message["is_playing"] = True
+    return message, (room_id, BROADCAST_TYPES[event], position)
+
+
+async def read_frames(websocket, room_id, stats):
+    async for raw in websocket:
+        stats.received += 1
+        frame = json.loads(raw)
+        if frame.get("type") == "chat_error":
+            stats.errors["chat_error"] += 1
+            continue
+        key = frame_key(room_id, frame)
+        if key is not None:
+            stats.observe(key)
+
 
-ROOM_ID = "9e459b15-c3d9-443a-bc75-8c4a5079a465"
-WS_URL = f"ws://localhost:8000/ws/rooms/{ROOM_ID}/"
+async def drive_events(websocket, room_id, stats, args, deadline):
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(random.expovariate(args.rate))
+        message, key = next_event(room_id, args.mix)
+        stats.expect(key)
+        await websocket.send(json.dumps(message))
+        stats.sent += 1
 
 
-async def test_websocket():
-    print(f"Connecting to {WS_URL}...")
+async def viewer(room_id, index, stats, args, deadline, is_actor):
+    url = f"{args.ws_url}/ws/rooms/{room_id}/"
+    started = time.perf_counter()
+    try:
+        async with websockets.connect(
+            url, open_timeout=args.connect_timeout, max_queue=None
+        ) as websocket:
+            await asyncio.wait_for(websocket.recv(), args.connect_timeout)
+            stats.connect_latencies.append(time.perf_counter() - started)
+            stats.connected += 1
+            await websocket.send(json.dumps({"type": "join", "username": f"viewer-{index}"}))
 
-    async with websockets.connect(WS_URL) as websocket:
-        print("Connected!")
+            reader = asyncio.create_task(read_frames(websocket, room_id, stats))
+            try:
+                if is_actor:
+                    await drive_events(websocket, room_id, stats, args, deadline)
+                remaining = deadline - time.perf_counter()
+                if remaining > 0:
+                    await asyncio.wait_for(asyncio.shield(reader), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                reader.cancel()
+    except websockets.ConnectionClosedError as exc:
+        stats.errors[f"closed {exc.code}"] += 1
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as exc:
+        stats.errors[type(exc).__name__] += 1
 
-        initial_message = await websocket.recv()
-        print(f"Received initial state: {initial_message}")
 
-        print("\nSending PLAY event...")
-        await websocket.send(
-            json.dumps({"type": "play", "current_time": 10.5})
-        )
+async def run(args):
+    room_ids = list(args.room)
+    if not room_ids:
+        room_ids = [await asyncio.to_thread(create_room, args.api_url) for _ in range(args.rooms)]
 
-        response = await websocket.recv()
-        print(f"Received: {response}")
+    stats = Stats()
+    total = len(room_ids) * args.viewers
+    started = time.perf_counter()
+    deadline = started + args.ramp + args.duration
+    tasks = []
+    for number in range(total):
+        room_id = room_ids[number % len(room_ids)]
+        is_actor = number // len(room_ids) < args.actors
+        tasks.append(asyncio.create_task(viewer(room_id, number, stats, args, deadline, is_actor)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / total)
+    await asyncio.gather(*tasks)
+    report(stats, total, time.perf_counter() - started, args)
 
-        print("\n⏸Sending PAUSE event...")
-        await websocket.send(
-            json.dumps({"type": "pause", "current_time": 15.2})
-        )
 
-        response = await websocket.recv()
-        print(f"Received: {response}")
+def report(stats, total, elapsed, args):
+    def ms(value):
+        return f"{value * 1000:8.1f} ms"
 
-        print("\nSending SEEK event...")
-        await websocket.send(
-            json.dumps({"type": "seek", "current_time": 120.0, "is_playing": True})
-        )
+    print(f"rooms x viewers     {total // max(args.viewers, 1)} x {args.viewers}")
+    print(f"connected           {stats.connected}/{total}")
+    print(
+        f"connect p50/p99     {ms(percentile(stats.connect_latencies, 0.5))}"
+        f" {ms(percentile(stats.connect_latencies, 0.99))}"
+    )
+    print(f"events sent         {stats.sent} ({stats.sent / elapsed:.1f}/s)")
+    print(f"frames received     {stats.received} ({stats.received / elapsed:.1f}/s)")
+    print(f"fan-out deliveries  {len(stats.fanout_latencies)}")
+    print(
+        f"fan-out p50/p99     {ms(percentile(stats.fanout_latencies, 0.5))}"
+        f" {ms(percentile(stats.fanout_latencies, 0.99))}"
+    )
+    errors = sum(stats.errors.values())
+    attempts = total + stats.sent
+    print(f"errors              {errors} ({errors / attempts:.2%} of connects + events)")
+    for name, count in stats.errors.most_common():
+        print(f"  {name:<18}{count}")
 
-        response = await websocket.recv()
-        print(f"Received: {response}")
 
-        print("\nWebSocket test completed!")
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ws-url", default="ws://localhost:8000")
+    parser.add_argument("--api-url", default="http://localhost:8000/api")
+    parser.add_argument("--room", action="append", default=[], help="Use an existing room")
+    parser.add_argument("--rooms", type=int, default=10, help="Rooms to create")
+    parser.add_argument("--viewers", type=int, default=20, help="Viewers per room")
+    parser.add_argument("--actors", type=int, default=1, help="Viewers per room sending events")
+    parser.add_argument("--rate", type=float, default=1.0, help="Events per second per actor")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix("play=1,pause=1,seek=1,chat=3"),
+        help="Relative weights of play/pause/seek/chat events",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load after ramp")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds to spread connects over")
+    parser.add_argument("--connect-timeout", type=float, default=10)
+    asyncio.run(run(parser.parse_args()))
 
 
 if __name__ == "__main__":
-    asyncio.run(test_websocket())
+    main()
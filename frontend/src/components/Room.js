@@ -151,6 +151,23 @@ function Room() {
       setConnectedUsers(data.users || []);
     });
 
+    wsService.on('user_joined', (data) => {
+      setConnectedUsers((users) => [
+        ...users.filter((user) => user.id !== data.user.id),
+        data.user,
+      ]);
+    });
+
+    wsService.on('user_left', (data) => {
+      setConnectedUsers((users) => users.filter((user) => user.id !== data.id));
+    });
+
+    wsService.on('user_renamed', (data) => {
+      setConnectedUsers((users) => users.map((user) => (
+        user.id === data.user.id ? data.user : user
+      )));
+    });
+
     wsService.on('video_changed', (data) => {
       console.log('Video changed event received:', data.video_url);
       if (data.video_url) {
@@ -309,12 +326,12 @@ function Room() {
               <span style={styles.badge}>{connectedUsers.length}</span>
             </div>
             <div style={styles.usersList}>
-              {connectedUsers.map((user, index) => (
-                <div key={index} style={styles.userItem}>
+              {connectedUsers.map((user) => (
+                <div key={user.id} style={styles.userItem}>
                   <div style={styles.userAvatar}>
-                    {user.charAt(0).toUpperCase()}
+                    {user.username.charAt(0).toUpperCase()}
                   </div>
-                  <span style={styles.userName}>{user}</span>
+                  <span style={styles.userName}>{user.username}</span>
                 </div>
               ))}
             </div>
@@ -4,6 +4,9 @@ import YouTubePlayer from './YouTubePlayer';
 import IframePlayer from './IframePlayer';
 import ObutPlayer from './ObutPlayer';
 
+// Seconds the local player may drift from the server clock before it is corrected.
+const DRIFT_TOLERANCE = 1.5;
+
 function VideoPlayer({ roomId, videoUrl, videoTitle, onClearVideo, initialRoomState }) {
   const ytPlayerRef = useRef(null);
   const videoRef = useRef(null);
@@ -237,16 +240,42 @@ function VideoPlayer({ roomId, videoUrl, videoTitle, onClearVideo, initialRoomSt
       setTimeout(() => { isSyncingRef.current = false; }, 1000);
     };
 
+    const handleTick = (data) => {
+      if (isSyncingRef.current || !data.is_playing) {
+        return;
+      }
+      const drift = Math.abs(getCurrentPlayerTime() - data.current_time);
+      if (drift < DRIFT_TOLERANCE) {
+        return;
+      }
+
+      console.log('VideoPlayer: correcting drift of', drift, 'seconds');
+      isSyncingRef.current = true;
+      lastTimeRef.current = data.current_time;
+
+      if (youtubeId && ytPlayerRef.current && typeof ytPlayerRef.current.seekTo === 'function') {
+        ytPlayerRef.current.seekTo(data.current_time, true);
+      } else if ((isObut || isEmbed) && iframePlayerRef.current && iframePlayerRef.current.seekTo) {
+        iframePlayerRef.current.seekTo(data.current_time);
+      } else if (isDirectVideo && videoRef.current) {
+        videoRef.current.currentTime = data.current_time;
+      }
+
+      setTimeout(() => { isSyncingRef.current = false; }, 1000);
+    };
+
     wsService.on('play', handleWSPlay);
     wsService.on('pause', handleWSPause);
     wsService.on('seek', handleWSSeek);
     wsService.on('room_state', handleRoomState);
+    wsService.on('tick', handleTick);
 
     return () => {
       wsService.off('play', handleWSPlay);
       wsService.off('pause', handleWSPause);
       wsService.off('seek', handleWSSeek);
       wsService.off('room_state', handleRoomState);
+      wsService.off('tick', handleTick);
     };
   }, [youtubeId, isDirectVideo, isObut, isEmbed]);
 
@@ -14,6 +14,7 @@ export const roomAPI = {
   getRoom: (roomId) => api.get(`/rooms/${roomId}/`),
   getRoomState: (roomId) => api.get(`/rooms/${roomId}/state/`),
   updateRoomState: (roomId, data) => api.patch(`/rooms/${roomId}/state/`, data),
+  getMessages: (roomId, params = {}) => api.get(`/rooms/${roomId}/messages/`, { params }),
 };
 
 export const videoAPI = {
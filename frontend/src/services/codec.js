@@ -0,0 +1,43 @@
+// Binary playback frames for the "tandem.bin.v2" subprotocol (see backend/rooms/codec.py).
+// All fields are big-endian; bit 0 of the flags byte is is_playing.
+
+export const SUBPROTOCOL = 'tandem.bin.v2';
+
+const TYPES = { play: 1, pause: 2, seek: 3, tick: 4 };
+const NAMES = { 1: 'play', 2: 'pause', 3: 'seek', 4: 'tick' };
+const IS_PLAYING = 0x01;
+const PLAYBACK_SIZE = 10;
+// Playback frames from the server carry the room event number after the flags.
+const SEQUENCED_SIZE = 14;
+const TICK_SIZE = 22;
+
+export const encodePlayback = (type, currentTime, isPlaying = false) => {
+  const view = new DataView(new ArrayBuffer(PLAYBACK_SIZE));
+  view.setUint8(0, TYPES[type]);
+  view.setUint8(1, isPlaying ? IS_PLAYING : 0);
+  view.setFloat64(2, currentTime ?? NaN);
+  return view.buffer;
+};
+
+export const decode = (buffer) => {
+  const view = new DataView(buffer);
+  const type = NAMES[view.getUint8(0)];
+  if (!type) {
+    return null;
+  }
+  const sequenced = type !== 'tick' && buffer.byteLength === SEQUENCED_SIZE;
+  const position = view.getFloat64(sequenced ? 6 : 2);
+  const frame = {
+    type,
+    is_playing: (view.getUint8(1) & IS_PLAYING) !== 0,
+    current_time: Number.isNaN(position) ? null : position,
+  };
+  if (sequenced) {
+    frame.seq = view.getUint32(2);
+  }
+  if (type === 'tick' && buffer.byteLength === TICK_SIZE) {
+    frame.playback_rate = view.getFloat32(10);
+    frame.server_time = view.getFloat64(14);
+  }
+  return frame;
+};
@@ -1,3 +1,5 @@
+import { SUBPROTOCOL, encodePlayback, decode } from './codec';
+
 const getWsUrl = () => {
   // If env variable is set and not localhost, use it
   if (process.env.REACT_APP_WS_URL && !process.env.REACT_APP_WS_URL.includes('localhost')) {
@@ -20,6 +22,11 @@ const getWsUrl = () => {
 };
 
 const WS_URL = getWsUrl();
+const CLOCK_SYNC_INTERVAL = 30000;
+// How long a missing room event may stay missing before the missed events are fetched again.
+const GAP_TIMEOUT = 2000;
+// Opt in to compact binary play/pause/seek/tick frames; the server falls back to JSON.
+const USE_BINARY = process.env.REACT_APP_WS_BINARY === 'true';
 
 class WebSocketService {
   constructor() {
@@ -31,9 +38,18 @@ class WebSocketService {
     this.maxReconnectAttempts = 5;
     this.reconnectDelay = 1000;
     this.shouldReconnect = true;
+    this.clockOffset = 0;
+    this.clockSyncTimer = null;
+    // Number of the last room event received with none missing before it, sent back on
+    // reconnect to resume from it. Events are numbered before they are broadcast, so two
+    // published at once can arrive out of order; those received past a gap are kept in
+    // seenSeqs until the gap fills, or are resumed from lastSeq if it does not.
+    this.lastSeq = null;
+    this.seenSeqs = new Set();
+    this.gapTimer = null;
   }
 
-  connect(roomId, username = 'Guest') {
+  connect(roomId, username = 'Guest', resume = false) {
     // Prevent rapid reconnects
     if (this.socket && this.socket.readyState === WebSocket.CONNECTING) {
       console.log('WebSocket already connecting, skipping...');
@@ -46,22 +62,30 @@ class WebSocketService {
       this.shouldReconnect = false; // Отключаем автореконнект перед закрытием
       this.socket.close();
       // Даём время на закрытие
-      setTimeout(() => this._createConnection(roomId, username), 100);
+      setTimeout(() => this._createConnection(roomId, username, resume), 100);
       return;
     }
 
-    this._createConnection(roomId, username);
+    this._createConnection(roomId, username, resume);
   }
 
-  _createConnection(roomId, username) {
+  _createConnection(roomId, username, resume = false) {
+    if (!resume || roomId !== this.roomId) {
+      this.lastSeq = null;
+    }
+    this.seenSeqs.clear();
+    clearTimeout(this.gapTimer);
+    this.gapTimer = null;
     this.roomId = roomId;
     this.username = username;
     this.shouldReconnect = true;
     this.reconnectAttempts = 0;
-    const url = `${WS_URL}/rooms/${roomId}/`;
+    const query = this.lastSeq !== null ? `?resume=${this.lastSeq}` : '';
+    const url = `${WS_URL}/rooms/${roomId}/${query}`;
 
     console.log('WebSocket connecting to:', url);
-    this.socket = new WebSocket(url);
+    this.socket = USE_BINARY ? new WebSocket(url, [SUBPROTOCOL]) : new WebSocket(url);
+    this.socket.binaryType = 'arraybuffer';
 
     this.socket.onopen = () => {
       console.log('WebSocket connected');
@@ -70,15 +94,35 @@ class WebSocketService {
         type: 'join',
         username: this.username,
       }));
+      this.syncClock();
+      clearInterval(this.clockSyncTimer);
+      this.clockSyncTimer = setInterval(() => this.syncClock(), CLOCK_SYNC_INTERVAL);
       this.emit('connected');
     };
 
     this.socket.onmessage = (event) => {
-      const data = JSON.parse(event.data);
+      const data = typeof event.data === 'string' ? JSON.parse(event.data) : decode(event.data);
+      if (!data) {
+        return;
+      }
+      if (data.seq !== undefined && !this.trackSeq(data)) {
+        return;
+      }
       console.log('WebSocket message:', data);
       this.emit('message', data);
 
-      if (data.type) {
+      if (data.type === 'pong') {
+        // NTP-style estimate: assume the reply took half the round trip.
+        const now = Date.now() / 1000;
+        const roundTrip = now - data.client_time;
+        this.clockOffset = data.server_time - (data.client_time + roundTrip / 2);
+      } else if (data.type === 'snapshot') {
+        const state = { ...data.state, current_time: this.projectPosition(data.state) };
+        this.emit('room_state', { ...state, video: data.video });
+        this.emit('chat_history', { messages: data.messages });
+      } else if (data.type === 'tick') {
+        this.emit('tick', { ...data, current_time: this.projectPosition(data) });
+      } else if (data.type) {
         this.emit(data.type, data);
       }
     };
@@ -90,6 +134,7 @@ class WebSocketService {
 
     this.socket.onclose = (event) => {
       console.log('WebSocket closed, code:', event.code, 'reason:', event.reason);
+      clearInterval(this.clockSyncTimer);
       this.emit('closed');
       
       // Auto-reconnect if not intentionally disconnected
@@ -100,20 +145,80 @@ class WebSocketService {
         this.emit('reconnecting', { attempt: this.reconnectAttempts, maxAttempts: this.maxReconnectAttempts });
         setTimeout(() => {
           if (this.shouldReconnect) {
-            this.connect(this.roomId, this.username);
+            this.connect(this.roomId, this.username, true);
           }
         }, delay);
       }
     };
   }
 
+  // Returns false for a room event that has already been received, e.g. live and again
+  // when replayed on resume.
+  trackSeq(data) {
+    if (data.type === 'snapshot' || this.lastSeq === null) {
+      this.lastSeq = data.seq;
+      this.seenSeqs.clear();
+    } else if (data.type === 'resumed') {
+      // Everything up to data.seq has been replayed ahead of this frame.
+      this.lastSeq = Math.max(this.lastSeq, data.seq);
+      this.seenSeqs.forEach((seq) => seq <= this.lastSeq && this.seenSeqs.delete(seq));
+    } else if (data.seq <= this.lastSeq || this.seenSeqs.has(data.seq)) {
+      return false;
+    } else {
+      this.seenSeqs.add(data.seq);
+    }
+    while (this.seenSeqs.delete(this.lastSeq + 1)) {
+      this.lastSeq += 1;
+    }
+    if (this.seenSeqs.size === 0) {
+      clearTimeout(this.gapTimer);
+      this.gapTimer = null;
+    } else if (this.gapTimer === null) {
+      this.gapTimer = setTimeout(() => this.resumeGap(), GAP_TIMEOUT);
+    }
+    return true;
+  }
+
+  resumeGap() {
+    this.gapTimer = null;
+    if (this.seenSeqs.size > 0 && this.socket && this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify({ type: 'resume', seq: this.lastSeq }));
+    }
+  }
+
+  syncClock() {
+    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify({
+        type: 'ping',
+        client_time: Date.now() / 1000,
+      }));
+    }
+  }
+
+  projectPosition(state) {
+    if (!state.is_playing || state.server_time === undefined) {
+      return state.current_time;
+    }
+    const serverNow = Date.now() / 1000 + this.clockOffset;
+    const elapsed = Math.max(0, serverNow - state.server_time);
+    return state.current_time + elapsed * (state.playback_rate || 1);
+  }
+
+  sendPlayback(event) {
+    if (this.socket.protocol === SUBPROTOCOL) {
+      this.socket.send(encodePlayback(event.type, event.current_time, event.is_playing));
+    } else {
+      this.socket.send(JSON.stringify(event));
+    }
+  }
+
   sendPlay(currentTime) {
     if (this.socket && this.socket.readyState === WebSocket.OPEN) {
       console.log('WebSocketService: Sending play event, time:', currentTime);
-      this.socket.send(JSON.stringify({
+      this.sendPlayback({
         type: 'play',
         current_time: currentTime,
-      }));
+      });
     } else {
       console.error('WebSocketService: Cannot send play - socket not ready', this.socket?.readyState);
     }
@@ -122,10 +227,10 @@ class WebSocketService {
   sendPause(currentTime) {
     if (this.socket && this.socket.readyState === WebSocket.OPEN) {
       console.log('WebSocketService: Sending pause event, time:', currentTime);
-      this.socket.send(JSON.stringify({
+      this.sendPlayback({
         type: 'pause',
         current_time: currentTime,
-      }));
+      });
     } else {
       console.error('WebSocketService: Cannot send pause - socket not ready', this.socket?.readyState);
     }
@@ -134,11 +239,11 @@ class WebSocketService {
   sendSeek(currentTime, isPlaying) {
     if (this.socket && this.socket.readyState === WebSocket.OPEN) {
       console.log('WebSocketService: Sending seek event, time:', currentTime);
-      this.socket.send(JSON.stringify({
+      this.sendPlayback({
         type: 'seek',
         current_time: currentTime,
         is_playing: isPlaying,
-      }));
+      });
     } else {
       console.error('WebSocketService: Cannot send seek - socket not ready', this.socket?.readyState);
     }
@@ -202,6 +307,9 @@ class WebSocketService {
 
   disconnect() {
     this.shouldReconnect = false;
+    clearInterval(this.clockSyncTimer);
+    clearTimeout(this.gapTimer);
+    this.gapTimer = null;
     if (this.socket) {
       this.socket.close();
       this.socket = null;